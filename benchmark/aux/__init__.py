@@ -1,6 +1,14 @@
+from benchmark.aux.batch_predict import BATCH_PREDICT, BatchPredictCommand
+from benchmark.aux.chip_index import CHIP_INDEX, ChipIndexCommand
 from benchmark.aux.preprocess import PREPROCESS, PreProcessCommand
 from benchmark.aux.postprocess import POSTPROCESS, PostProcessCommand
+from benchmark.aux.resample import RESAMPLE, ResampleCommand
+from benchmark.aux.submission import SUBMISSION, SubmissionCommand
 
 def register_plugin(plugin_registry):
     plugin_registry.register_aux_command(PREPROCESS, PreProcessCommand)
-    plugin_registry.register_aux_command(POSTPROCESS, PostProcessCommand)
\ No newline at end of file
+    plugin_registry.register_aux_command(POSTPROCESS, PostProcessCommand)
+    plugin_registry.register_aux_command(SUBMISSION, SubmissionCommand)
+    plugin_registry.register_aux_command(CHIP_INDEX, ChipIndexCommand)
+    plugin_registry.register_aux_command(RESAMPLE, ResampleCommand)
+    plugin_registry.register_aux_command(BATCH_PREDICT, BatchPredictCommand)
\ No newline at end of file
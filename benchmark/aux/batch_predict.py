@@ -0,0 +1,172 @@
+import os
+from os.path import basename, join, splitext
+
+import numpy as np
+
+import rasterio
+import rastervision as rv
+import torch
+from benchmark.aux.postprocess import get_reference_uri, make_lut, read_remapped
+from benchmark.io import upload
+from benchmark.utils import bounded_map, retry
+from rasterio.io import MemoryFile
+from rastervision.core.box import Box
+from rastervision.predictor import Predictor
+from rastervision.rv_config import RVConfig
+
+BATCH_PREDICT = 'BATCH_PREDICT'
+
+
+def get_prediction_uri(output_dir, image_uri):
+    chip_id = splitext(basename(image_uri))[0]
+    return join(output_dir, '{}.tif'.format(chip_id))
+
+
+def _load_chip(uri, chip_size, channel_order):
+    with rasterio.open(uri) as src:
+        img = np.transpose(src.read([c + 1 for c in channel_order]), (1, 2, 0))
+        profile = src.profile.copy()
+
+    # Same sliding windows as rv's predict, zero padded past the chip's edge
+    height, width = img.shape[:2]
+    windows = [Box(r, c, r + chip_size, c + chip_size)
+               for r in range(0, height, chip_size) for c in range(0, width, chip_size)]
+    chips = []
+    for w in windows:
+        chip = np.zeros((chip_size, chip_size, img.shape[2]), dtype=np.uint8)
+        crop = img[w.ymin:w.ymax, w.xmin:w.xmax]
+        chip[:crop.shape[0], :crop.shape[1]] = crop
+        chips.append(chip)
+    return uri, profile, windows, chips
+
+
+def _write_prediction(labels, profile, output_uri, tmp_dir, lut=None, reference_uri=None):
+    # With a lookup table the prediction is written straight in submission format,
+    # so the raw class ids never reach storage
+    profile = dict(profile, driver='GTiff', count=1, dtype=np.uint8, nodata=None)
+    profile.pop('photometric', None)
+    lut = lut if lut is not None else np.arange(256, dtype=np.uint8)
+    if reference_uri:
+        # Brought back onto the grid of the original test chip by the same read as
+        # POSTPROCESS, so the fused output matches it pixel for pixel
+        with MemoryFile() as memfile:
+            with memfile.open(**profile) as dst:
+                dst.write(labels, 1)
+            with memfile.open() as src, rasterio.open(reference_uri) as reference:
+                img, profile = read_remapped(src, lut, reference)
+        labels = img[0]
+    else:
+        labels = np.take(lut, labels, mode='clip')
+    profile.update(compress='DEFLATE')
+    tmp_uri = join(tmp_dir, basename(output_uri))
+    with rasterio.open(tmp_uri, 'w', **profile) as dst:
+        dst.write(labels, 1)
+    upload(tmp_uri, output_uri)
+    if tmp_uri != output_uri:
+        os.remove(tmp_uri)
+
+
+class _BatchPredictor():
+    def __init__(self, bundle_uri, tmp_dir, batch_size):
+        # The model is loaded once and reused for every chip
+        self.predictor = Predictor(bundle_uri, tmp_dir)
+        self.predictor.load_model()
+        self.backend = self.predictor.backend
+        self.model = self.backend.model.eval()
+        self.chip_size = self.predictor.task_config.predict_chip_size
+        self.batch_size = batch_size
+        self.batch = []
+
+    def add(self, chip, window, out):
+        # Queue one window; returns the outputs completed by running the batch
+        self.batch.append((chip, window, out))
+        if len(self.batch) >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        if not self.batch:
+            return []
+        # The pytorch backend's predict only labels the first chip it is given, so the
+        # stacked batch goes through its model directly. Scaling and argmax are the same
+        # as in backend.predict.
+        chips = np.stack([chip for chip, _, _ in self.batch])
+        x = torch.Tensor(chips).permute((0, 3, 1, 2)) / 255.
+        with torch.no_grad():
+            preds = self.model(x.to(self.backend.device))['out'].argmax(1).cpu().numpy()
+
+        done = []
+        for chip, label_arr, (_, w, out) in zip(chips, preds, self.batch):
+            # As in rv's predict_scene, nodata pixels in the imagery are set to 0
+            label_arr[np.sum(chip, axis=2) == 0] = 0
+            arr = out['labels'][w.ymin:w.ymax, w.xmin:w.xmax]
+            arr[:] = label_arr[:arr.shape[0], :arr.shape[1]]
+            out['remaining'] -= 1
+            if out['remaining'] == 0:
+                done.append(out)
+        self.batch = []
+        return done
+
+
+def batch_predict(uris, bundle_uri, output_dir, batch_size=16, num_workers=8, attempts=3,
+                  channel_order=(0, 1, 2), remap=False, reference_dir=None):
+    lut = make_lut() if remap else None
+    with RVConfig.get_tmp_dir() as tmp_dir:
+        predictor = _BatchPredictor(bundle_uri, tmp_dir, batch_size)
+
+        # Chips are decoded ahead of the model by a prefetch pool and finished
+        # predictions are handed off to a writer pool, so the forward passes run
+        # back to back. Both pools are bounded so that neither decoded chips nor
+        # finished label arrays pile up when one side falls behind.
+        def load(uri):
+            return retry(lambda: _load_chip(uri, predictor.chip_size, channel_order),
+                         attempts)
+
+        def predictions():
+            for uri, profile, windows, chips in bounded_map(load, uris, num_workers):
+                out = {
+                    'uri': get_prediction_uri(output_dir, uri),
+                    'profile': profile,
+                    'labels': np.zeros((profile['height'], profile['width']), dtype=np.uint8),
+                    'remaining': len(windows),
+                    'reference_uri': get_reference_uri(reference_dir, uri)
+                    if reference_dir else None
+                }
+                for chip, window in zip(chips, windows):
+                    yield from predictor.add(chip, window, out)
+            yield from predictor.flush()
+
+        def write(out):
+            retry(lambda: _write_prediction(out['labels'], out['profile'], out['uri'],
+                                            tmp_dir, lut, out['reference_uri']),
+                  attempts)
+
+        for _ in bounded_map(write, predictions(), num_workers):
+            pass
+
+
+class BatchPredictCommand(rv.AuxCommand):
+    command_type = BATCH_PREDICT
+    options = rv.AuxCommandOptions(
+        split_on='uris',
+        inputs=lambda conf: BatchPredictCommand.gather_inputs(conf),
+        outputs=lambda conf: BatchPredictCommand.gather_outputs(conf),
+        required_fields=['uris', 'bundle_uri', 'output_dir'])
+
+    def run(self):
+        batch_predict(self.command_config['uris'],
+                      self.command_config['bundle_uri'],
+                      self.command_config['output_dir'],
+                      batch_size=self.command_config.get('batch_size', 16),
+                      num_workers=self.command_config.get('num_workers', 8),
+                      attempts=self.command_config.get('attempts', 3),
+                      remap=self.command_config.get('remap', False),
+                      reference_dir=self.command_config.get('reference_dir'))
+
+    @staticmethod
+    def gather_inputs(conf):
+        return [conf['bundle_uri']] + conf['uris']
+
+    @staticmethod
+    def gather_outputs(conf):
+        return [get_prediction_uri(conf['output_dir'], uri) for uri in conf['uris']]
@@ -0,0 +1,133 @@
+import json
+import random
+
+import numpy as np
+
+import rasterio
+import rastervision as rv
+from benchmark.labels import BUILDING_VALUE, load_label_shapes, rasterize_labels
+from rasterio.warp import transform_geom
+from rastervision.utils.files import str_to_file
+
+CHIP_INDEX = 'CHIP_INDEX'
+
+
+def _window_sums(mask, chip_size, stride):
+    # Sum of mask over every chip window (windows hanging off the edge are clipped).
+    # The mask is first reduced to stride x stride cells so that the summed area table
+    # stays tiny even for 9000px splits.
+    if chip_size % stride:
+        raise ValueError('chip_size ({}) must be a multiple of stride ({})'.format(
+            chip_size, stride))
+    height, width = mask.shape
+    rows = np.arange(0, height, stride)
+    cols = np.arange(0, width, stride)
+    cells = np.add.reduceat(np.add.reduceat(mask, rows, axis=0, dtype=np.int64),
+                            cols, axis=1)
+
+    table = np.zeros((len(rows) + 1, len(cols) + 1), dtype=np.int64)
+    table[1:, 1:] = cells.cumsum(axis=0).cumsum(axis=1)
+    k = chip_size // stride
+    i0, j0 = np.meshgrid(np.arange(len(rows)), np.arange(len(cols)), indexing='ij')
+    i1 = np.minimum(i0 + k, len(rows))
+    j1 = np.minimum(j0 + k, len(cols))
+    sums = table[i1, j1] - table[i0, j1] - table[i1, j0] + table[i0, j0]
+    return i0 * stride, j0 * stride, sums
+
+
+def index_chips(raster_uri, label_uri, shapes, chip_size, stride):
+    with rasterio.open(raster_uri) as src:
+        valid = src.read(src.count) == 255
+        if shapes is None:
+            # Label rasters from PREPROCESS are already on the split's grid
+            with rasterio.open(label_uri) as label_src:
+                labels = label_src.read(1)
+        else:
+            labels = rasterize_labels(shapes, src.transform, (src.height, src.width))
+
+    r0, c0, valid_sums = _window_sums(valid, chip_size, stride)
+    _, _, building_sums = _window_sums(labels == BUILDING_VALUE, chip_size, stride)
+    area = float(chip_size * chip_size)
+    return [{
+        'window': [int(c), int(r), chip_size, chip_size],
+        'valid_fraction': float(v) / area,
+        'building_fraction': float(b) / area
+    } for r, c, v, b in zip(r0.ravel(), c0.ravel(), valid_sums.ravel(),
+                            building_sums.ravel())]
+
+
+def select_chips(chips, min_valid_fraction, background_ratio, seed=0):
+    # Drop windows that are mostly nodata, then keep at most background_ratio
+    # background windows for every window that contains buildings
+    chips = [c for c in chips if c['valid_fraction'] >= min_valid_fraction]
+    building = [c for c in chips if c['building_fraction'] > 0]
+    background = [c for c in chips if c['building_fraction'] == 0]
+    if background_ratio is not None:
+        num_background = int(round(len(building) * background_ratio))
+        if num_background < len(background):
+            background = random.Random(seed).sample(background, num_background)
+    return building + background
+
+
+def _make_aoi(chips, transform, crs):
+    # One polygon per kept window, padded by half a pixel so that the reprojected
+    # polygon still contains the window rv generates
+    features = []
+    for chip in chips:
+        col, row, width, height = chip['window']
+        corners = [(col - 0.5, row - 0.5), (col + width + 0.5, row - 0.5),
+                   (col + width + 0.5, row + height + 0.5), (col - 0.5, row + height + 0.5)]
+        ring = [transform * c for c in corners]
+        geom = {'type': 'Polygon', 'coordinates': [ring + [ring[0]]]}
+        if crs:
+            geom = transform_geom(crs, 'EPSG:4326', geom)
+        features.append({'type': 'Feature', 'properties': {}, 'geometry': geom})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+class ChipIndexCommand(rv.AuxCommand):
+    command_type = CHIP_INDEX
+    options = rv.AuxCommandOptions(
+        split_on='scenes',
+        inputs=lambda conf: ChipIndexCommand.gather_inputs(conf),
+        outputs=lambda conf: ChipIndexCommand.gather_outputs(conf),
+        required_fields=['scenes'])
+
+    def run(self):
+        chip_size = self.command_config.get('chip_size', 300)
+        stride = self.command_config.get('stride', chip_size)
+        min_valid_fraction = self.command_config.get('min_valid_fraction', 0.5)
+        background_ratio = self.command_config.get('background_ratio', 1.0)
+
+        # All of the splits of a scene share its label geojson so it is parsed once
+        shapes = {}
+        for scene in self.command_config['scenes']:
+            with rasterio.open(scene['raster_uri']) as src:
+                transform, crs = src.transform, src.crs
+            crs = crs.to_string() if crs else None
+            key = (scene['label_uri'], crs)
+            if scene['label_uri'].endswith('.tif'):
+                shapes[key] = None
+            elif key not in shapes:
+                shapes[key] = load_label_shapes(scene['label_uri'], crs)
+
+            chips = index_chips(scene['raster_uri'], scene['label_uri'], shapes[key],
+                                chip_size, stride)
+            kept = select_chips(chips, min_valid_fraction, background_ratio,
+                                seed=scene['id'])
+            for chip in chips:
+                chip['kept'] = False
+            for chip in kept:
+                chip['kept'] = True
+
+            str_to_file(json.dumps({'id': scene['id'], 'chips': chips}),
+                        scene['index_uri'])
+            str_to_file(json.dumps(_make_aoi(kept, transform, crs)), scene['aoi_uri'])
+
+    @staticmethod
+    def gather_inputs(conf):
+        return [scene['raster_uri'] for scene in conf['scenes']]
+
+    @staticmethod
+    def gather_outputs(conf):
+        return [scene['aoi_uri'] for scene in conf['scenes']]
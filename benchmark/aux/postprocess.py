@@ -1,32 +1,107 @@
 import os
-from os.path import basename, dirname, isdir, join
+from os.path import basename, dirname, isdir, join, splitext
+from urllib.parse import urlparse
 
 import numpy as np
 
 import rasterio
 import rastervision as rv
-from rastervision.utils.files import upload_or_copy, download_if_needed
+from benchmark.aux.profiling import Profiler, report_name
+from benchmark.constants import CLASSES, SUBMISSION_VALUES
+from benchmark.io import download, upload
+from benchmark.utils import bounded_map, retry
+from rasterio.enums import Resampling
 
 POSTPROCESS = 'POSTPROCESS'
 
 
-def _postprocess(pred_uri, experiment_id, root_uri):
-    tmp_pred_uri = download_if_needed(pred_uri, '/opt/data/predict/')
-    tmp_postprocess_uri = tmp_pred_uri.replace('/predict/', '/postprocess/')
-    
-    os.makedirs(dirname(tmp_postprocess_uri), exist_ok=True)
-    out_uri = join(root_uri, 'postprocess', experiment_id, basename(pred_uri))
+def _is_local(uri):
+    return urlparse(uri).scheme in ('', 'file')
+
+
+def make_lut(dtype=np.uint8):
+    # Identity everywhere except for the rv class ids, which map to the values the
+    # competition expects
+    lut = np.arange(np.iinfo(dtype).max + 1, dtype=dtype)
+    for name, (class_id, _) in CLASSES.items():
+        lut[class_id] = SUBMISSION_VALUES[name]
+    return lut
+
+
+def remap(src, dst, lut):
+    # Remap one block at a time, reusing the same buffer for every block of a given
+    # shape so no full-image temporaries are created
+    buf = None
+    for _, win in src.block_windows(1):
+        shape = (src.count, win.height, win.width)
+        if buf is None or buf.shape != shape:
+            buf = np.empty(shape, dtype=src.dtypes[0])
+        src.read(window=win, out=buf)
+        # mode='clip' lets numpy write into buf directly instead of buffering
+        np.take(lut, buf, out=buf, mode='clip')
+        dst.write(buf, window=win)
 
-    with rasterio.open(tmp_pred_uri) as src:
+
+def get_reference_uri(reference_dir, pred_uri):
+    # Test chips live at <test img dir>/<id>/<id>.tif
+    chip_id = splitext(basename(pred_uri))[0]
+    return join(reference_dir, chip_id, '{}.tif'.format(chip_id))
+
+
+def read_remapped(src, lut, reference=None):
+    # Remap a whole chip in one read. When a reference raster is given (i.e. the
+    # prediction was made at a coarser target GSD) the prediction is brought back onto
+    # the reference's grid with nearest neighbour resampling.
+    profile = src.profile.copy()
+    if reference is None:
         img = src.read()
-        img = np.where(img == 2, 0, img)
-        profile = src.profile
-    with rasterio.open(tmp_postprocess_uri, 'w', **profile) as dst:
-        dst.write(img)
+    else:
+        img = src.read(out_shape=(src.count, reference.height, reference.width),
+                       resampling=Resampling.nearest)
+        profile.update(height=reference.height, width=reference.width,
+                       transform=reference.transform)
+    np.take(lut, img, out=img, mode='clip')
+    return img, profile
+
 
-    upload_or_copy(tmp_postprocess_uri, out_uri)
-    for t in (tmp_pred_uri, tmp_postprocess_uri):
-        os.remove(t)
+def _postprocess(pred_uri, experiment_id, root_uri, lut, profiler, reference_dir=None):
+    out_uri = join(root_uri, 'postprocess', experiment_id, basename(pred_uri))
+
+    if _is_local(pred_uri):
+        src_uri = pred_uri
+    else:
+        with profiler.stage('download', pred_uri) as record:
+            src_uri = download(pred_uri, join('/opt/data/predict/', experiment_id,
+                                              basename(pred_uri)))
+            record['bytes_read'] = os.path.getsize(src_uri)
+
+    # Local outputs are written in place; remote ones go through a temp file
+    if _is_local(out_uri):
+        dst_uri = out_uri
+    else:
+        dst_uri = join('/opt/data/postprocess/', experiment_id, basename(pred_uri))
+    os.makedirs(dirname(dst_uri), exist_ok=True)
+
+    with profiler.stage('remap', pred_uri) as record:
+        with rasterio.open(src_uri) as src:
+            if reference_dir:
+                with rasterio.open(get_reference_uri(reference_dir, pred_uri)) as reference:
+                    img, profile = read_remapped(src, lut, reference)
+                with rasterio.open(dst_uri, 'w', **profile) as dst:
+                    dst.write(img)
+            else:
+                with rasterio.open(dst_uri, 'w', **src.profile) as dst:
+                    remap(src, dst, lut)
+        record['bytes_read'] = os.path.getsize(src_uri)
+        record['bytes_written'] = os.path.getsize(dst_uri)
+
+    if dst_uri != out_uri:
+        with profiler.stage('upload', out_uri) as record:
+            record['bytes_written'] = os.path.getsize(dst_uri)
+            upload(dst_uri, out_uri)
+        os.remove(dst_uri)
+    if src_uri != pred_uri:
+        os.remove(src_uri)
 
 
 class PostProcessCommand(rv.AuxCommand):
@@ -45,8 +120,27 @@ class PostProcessCommand(rv.AuxCommand):
         if not isdir(postprocess_dir):
             os.makedirs(postprocess_dir)
 
-        for uri in self.command_config['uris']:
-            _postprocess(uri, experiment_id, root_uri)
+        num_workers = self.command_config.get('num_workers', 16)
+        attempts = self.command_config.get('attempts', 3)
+        reference_dir = self.command_config.get('reference_dir')
+
+        # Chips are small so the work is dominated by network round trips. Running
+        # them on a bounded pool of threads overlaps downloads, remaps and uploads.
+        lut = make_lut()
+        profiler = Profiler()
+
+        def process(uri):
+            retry(lambda: _postprocess(uri, experiment_id, root_uri, lut, profiler,
+                                       reference_dir),
+                  attempts)
+
+        for _ in bounded_map(process, self.command_config['uris'], num_workers):
+            pass
+
+        # Stage timings are written next to the outputs and summarized in the log
+        profiler.save(join(root_uri, 'postprocess', 'reports', experiment_id,
+                           report_name(POSTPROCESS, self.command_config['uris'])))
+        profiler.print_summary(POSTPROCESS)
 
     @staticmethod
     def gather_inputs(conf):
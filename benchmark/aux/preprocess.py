@@ -1,70 +1,440 @@
+import hashlib
+import json
+import math
 import os
+from multiprocessing import Pool
 from os.path import basename, join
-from subprocess import call
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
 
 import numpy as np
 
 import rasterio
 import rastervision as rv
-from rasterio.windows import Window
-from rastervision.utils.files import upload_or_copy
+from affine import Affine
+from benchmark.io import get_s3_client
+from benchmark.resolution import decimated_shape, get_decimation
+from benchmark import labels
+from benchmark.aux.profiling import Profiler, report_name
+from rasterio.enums import Resampling
+from rasterio.windows import Window, bounds
+from rastervision.utils.files import (file_exists, file_to_str, str_to_file,
+                                     upload_or_copy)
 
 PREPROCESS = 'PREPROCESS'
 
+# Creation options for the image splits. Each of these can be overridden by a key
+# of the same name in the PREPROCESS command config.
+DEFAULT_ENCODING = {
+    'compress': 'JPEG',
+    'jpeg_quality': 100,
+    'tile_size': 512,
+    'overviews': [2, 4, 8, 16],
+    'target_gsd': None
+}
 
-def split_image(image_uri, split_dir):
-    with rasterio.open(image_uri) as src:
-        width = src.width
-        height = src.height
+# Creation options for the label rasters written next to each split
+LABEL_ENCODING = {
+    'compress': 'DEFLATE',
+    'tiled': True,
+    'blockxsize': 512,
+    'blockysize': 512
+}
 
-    win_size = 9000
+# Largest split to write, in uncompressed bytes. The default keeps splits of a 4 band
+# uint8 scene at about 9000 x 9000 pixels, which is what the training instances
+# can comfortably read.
+MAX_SPLIT_BYTES = 9000 * 9000 * 4
+
+# Open datasets keyed by uri. Every worker process builds up its own handles so
+# that rasterio/GDAL objects are never shared across processes. They live as long as
+# the scene's pool; the parent's handle is closed when split_image is done.
+_datasets = {}
+
+# Label polygons keyed by (label uri, crs), also kept per process so a scene's
+# geojson is parsed once by each worker rather than once per split. Like the datasets
+# they go away with the scene's pool, and the parent drops its own after each scene.
+_label_shapes = {}
+
+# Stage timings for this process. Pool workers send theirs back to the parent along
+# with the result of each task.
+_profiler = Profiler()
+
+
+def _open(image_uri):
+    if image_uri not in _datasets:
+        _datasets[image_uri] = rasterio.open(image_uri)
+    return _datasets[image_uri]
+
+
+def _close(image_uri):
+    src = _datasets.pop(image_uri, None)
+    if src is not None:
+        src.close()
+
+
+def _get_label_shapes(label_uri, crs):
+    if (label_uri, crs) not in _label_shapes:
+        _label_shapes[(label_uri, crs)] = labels.load_label_shapes(label_uri, crs)
+    return _label_shapes[(label_uri, crs)]
+
+
+def _drop_label_shapes(label_uri):
+    for key in [key for key in _label_shapes if key[0] == label_uri]:
+        del _label_shapes[key]
+
+
+def _parse_image_uri(image_uri):
+    # Scene images live at <stac root>/<area>/<image id>/<image id>.tif
+    return image_uri.split('/')[-3], image_uri.split('/')[-2]
+
+
+def _get_label_uri(image_uri):
+    # and their labels at <stac root>/<area>/<image id>-labels/<image id>.geojson
+    area_dir = image_uri.rsplit('/', 2)[0]
+    image_id = _parse_image_uri(image_uri)[1]
+    return join(area_dir, '{}-labels'.format(image_id), '{}.geojson'.format(image_id))
+
+
+def get_manifest_uri(split_dir, area, image_id):
+    return join(split_dir, area, image_id, '{}_manifest.json'.format(image_id))
+
+
+def _source_fingerprint(image_uri):
+    parsed = urlparse(image_uri)
+    if parsed.scheme == 's3':
+        head = get_s3_client().head_object(Bucket=parsed.netloc,
+                                          Key=parsed.path[1:])
+        return {'etag': head['ETag'], 'size': head['ContentLength']}
+    elif parsed.scheme in ('http', 'https'):
+        with urlopen(Request(image_uri, method='HEAD')) as response:
+            return {'etag': response.headers.get('ETag'),
+                    'size': int(response.headers.get('Content-Length', -1))}
+    else:
+        stat = os.stat(image_uri)
+        return {'etag': str(stat.st_mtime), 'size': stat.st_size}
+
+
+def _window_fingerprint(source, win, encoding):
+    key = json.dumps({
+        'source': source,
+        'window': [win.col_off, win.row_off, win.width, win.height],
+        'encoding': encoding
+    }, sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _is_current(output_uri, fingerprint):
+    if not file_exists(output_uri):
+        return False
+    with rasterio.open(output_uri) as split:
+        return split.tags().get('SPLIT_FINGERPRINT') == fingerprint
+
+
+def _load_manifest(manifest_uri):
+    if not file_exists(manifest_uri):
+        return None
+    return json.loads(file_to_str(manifest_uri))
+
+
+def _lcm(a, b):
+    return a * b // math.gcd(a, b)
+
+
+def _align(size, step):
+    # Round size down to a multiple of step, but never below one step
+    return max(step, size // step * step)
+
+
+def _block_grid(src):
+    # Internal block shape of the source. Striped sources span the full width (or
+    # height) in a single block, so there is nothing to line up along that axis.
+    block_height, block_width = src.block_shapes[0]
+    return (block_height if block_height < src.height else 1,
+            block_width if block_width < src.width else 1)
+
+
+def _get_win_size(src, max_split_bytes):
+    pixel_bytes = src.count * np.dtype(src.dtypes[0]).itemsize
+    return int(math.sqrt(max_split_bytes / pixel_bytes))
+
+
+def _get_windows(width, height, win_size, overlap=0, grid=(1, 1)):
+    # Window origins step along the source block grid so that no block is decoded for
+    # two windows. Each window extends overlap pixels into its neighbours and is
+    # clipped to the scene, so the last row and column are always covered.
+    if overlap >= win_size:
+        raise ValueError('overlap ({}) must be smaller than the window size ({})'.format(
+            overlap, win_size))
+    row_step = _align(win_size - overlap, grid[0])
+    col_step = _align(win_size - overlap, grid[1])
     wins = []
-    for c in list(range(0, width, win_size)):
-        if c >= width:
-            continue
-        if (c + win_size) > width:
-            win_width = width - c - 1
-        else:
-            win_width = win_size
-        for r in list(range(0, height, win_size)):
-            if r >= height:
-                continue
-            if (r + win_size) > height:
-                win_height = height - r - 1
-            else:
-                win_height = win_size
-            wins.append(Window(c, r, win_width, win_height))
-
-    i = 0
-    for win in wins:
-        with rasterio.open(image_uri) as src:
-            img = src.read(window=win)
-            win_transform = src.window_transform(win)
-            kwargs = src.meta.copy()
-
-        if np.max(img[-1]) == 255:
-            area = image_uri.split('/')[-3]
-            image_id = image_uri.split('/')[-2]
-            output_uri = join(split_dir, area, image_id,
-                            '{}_{}.tif'.format(image_id, i))
-            kwargs.update({
-                'height': win.height,
-                'width': win.width,
-                'transform': win_transform
-            })
-
-            tmp_uri = join('/tmp/', basename(output_uri))
-            with rasterio.open(tmp_uri, 'w', **kwargs) as dst:
-                dst.write(img)
-            tmp_cmpr_file = tmp_uri.replace('.tif', '_jpg.tif')
-            gdal_command = 'gdal_translate {} {} '.format(tmp_uri, tmp_cmpr_file) +\
-                '-co COMPRESS=JPEG -co JPEG_QUALITY=100 -co TILED=YES ' +\
-                '-co COPY_SRC_OVERVIEWS=YES -co BLOCKXSIZE=512 -co BLOCKYSIZE=512 --config COMPRESS_OVERVIEW JPEG'
-            call(gdal_command, shell=True)
-            upload_or_copy(tmp_cmpr_file, output_uri)
-            for t in (tmp_uri, tmp_cmpr_file):
-                os.remove(t)
-            i += 1
+    # A window that would fit entirely inside the overlap of the previous one is skipped
+    for c in range(0, max(width - overlap, 1), col_step):
+        for r in range(0, max(height - overlap, 1), row_step):
+            wins.append(Window(c, r, min(col_step + overlap, width - c),
+                               min(row_step + overlap, height - r)))
+    return wins
+
+
+def _get_block_shape(block_size, grid, factor=1):
+    # Sub-window shape for reads: a multiple of the source blocks (so that reads start
+    # and end on block edges) and of the decimation factor (so that they line up in
+    # the output)
+    return tuple(_align(block_size, _lcm(step, factor)) for step in grid)
+
+
+def _get_blocks(win, block_shape):
+    # Break a window into sub-windows of at most block_shape so that only a few tiles
+    # are ever held in memory at once
+    block_height, block_width = block_shape
+    for r in range(0, win.height, block_height):
+        for c in range(0, win.width, block_width):
+            yield Window(win.col_off + c, win.row_off + r,
+                         min(block_width, win.width - c),
+                         min(block_height, win.height - r))
+
+
+def _has_data(src, win, block_shape, record):
+    # Only the alpha band is read and we stop at the first valid pixel
+    for block in _get_blocks(win, block_shape):
+        alpha = src.read(src.count, window=block)
+        record['bytes_read'] += alpha.nbytes
+        if np.max(alpha) == 255:
+            return True
+    return False
+
+
+def _split_remainder(offset, size, factor):
+    # The part of a block that is a whole number of output pixels, then what is left
+    full = size // factor * factor
+    return [(offset + o, s) for o, s in ((0, full), (full, size - full)) if s]
+
+
+def _decimated_blocks(win, block_shape, factor):
+    # Pairs of source and output windows for writing a split. Blocks are multiples of
+    # factor except for the last one in each direction, whose remainder (under factor
+    # pixels) is read into a single partial output pixel of its own.
+    for block in _get_blocks(win, block_shape):
+        for row_off, height in _split_remainder(block.row_off - win.row_off,
+                                                block.height, factor):
+            for col_off, width in _split_remainder(block.col_off - win.col_off,
+                                                   block.width, factor):
+                out_height, out_width = decimated_shape(height, width, factor)
+                yield (Window(win.col_off + col_off, win.row_off + row_off, width, height),
+                       Window(col_off // factor, row_off // factor, out_width, out_height))
+
+
+def _split_grid(src, win, factor):
+    # Output transform and shape of a split, decimated by factor when the scene is
+    # resampled to a coarser target GSD. The split is read block by block with exactly
+    # factor source pixels per output pixel, so every output pixel is factor source
+    # pixels wide and only the last row and column may cover less of the window.
+    height, width = decimated_shape(win.height, win.width, factor)
+    transform = src.window_transform(win) * Affine.scale(factor)
+    return transform, height, width
+
+
+def _write_window(src, win, uri, block_shape, encoding, tags, record, factor=1):
+    transform, height, width = _split_grid(src, win, factor)
+    kwargs = src.meta.copy()
+    kwargs.update({
+        'driver': 'GTiff',
+        'height': height,
+        'width': width,
+        'transform': transform,
+        'compress': encoding['compress'],
+        'tiled': True,
+        'blockxsize': encoding['tile_size'],
+        'blockysize': encoding['tile_size']
+    })
+    if encoding['compress'].upper() == 'JPEG':
+        kwargs['jpeg_quality'] = encoding['jpeg_quality']
+
+    # The split is compressed and tiled as it is written so there is no need for a
+    # second pass through gdal_translate. Decimated reads let GDAL use the source's
+    # overviews when they are available.
+    with rasterio.Env(COMPRESS_OVERVIEW=encoding['compress'],
+                      JPEG_QUALITY_OVERVIEW=encoding['jpeg_quality']):
+        with rasterio.open(uri, 'w', **kwargs) as dst:
+            for block, dst_block in _decimated_blocks(win, block_shape, factor):
+                img = src.read(window=block,
+                               out_shape=(src.count, dst_block.height, dst_block.width),
+                               resampling=Resampling.average)
+                record['bytes_read'] += img.nbytes
+                dst.write(img, window=dst_block)
+            dst.update_tags(**tags)
+            if encoding['overviews']:
+                dst.build_overviews(encoding['overviews'], Resampling.average)
+    record['bytes_written'] += os.path.getsize(uri)
+
+
+def _write_labels(src, win, uri, label_uri, tags, record, factor=1):
+    crs = src.crs.to_string() if src.crs else None
+    transform, height, width = _split_grid(src, win, factor)
+    label_arr = labels.rasterize_labels(_get_label_shapes(label_uri, crs), transform,
+                                        (height, width),
+                                        background=labels.BACKGROUND_VALUE)
+    kwargs = dict(LABEL_ENCODING, driver='GTiff', count=1, dtype=label_arr.dtype,
+                  height=height, width=width, crs=src.crs, transform=transform)
+    with rasterio.open(uri, 'w', **kwargs) as dst:
+        dst.write(label_arr, 1)
+        dst.update_tags(**tags)
+    record['bytes_written'] += os.path.getsize(uri)
+
+
+def _upload(tmp_uri, uri):
+    with _profiler.stage('upload', uri) as record:
+        record['bytes_written'] = os.path.getsize(tmp_uri)
+        upload_or_copy(tmp_uri, uri)
+    os.remove(tmp_uri)
+
+
+def _split_tags(split, fingerprint):
+    # Each split describes the window it was cut from so that it can be placed back in
+    # the scene without the manifest
+    win = split['window']
+    return {
+        'SPLIT_FINGERPRINT': fingerprint,
+        'SPLIT_SOURCE': split['image_uri'],
+        'SPLIT_INDEX': split['index'],
+        'SPLIT_WINDOW': '{},{},{},{}'.format(win.col_off, win.row_off, win.width,
+                                             win.height),
+        'SPLIT_OVERLAP': split['overlap'],
+        'SPLIT_DECIMATION': split['factor']
+    }
+
+
+def _check_window(args):
+    image_uri, win, block_shape = args
+    with _profiler.stage('nodata_check', image_uri) as record:
+        has_data = _has_data(_open(image_uri), win, block_shape, record)
+    return has_data, _profiler.drain()
+
+
+def _split_window(args):
+    split, block_shape, encoding = args
+    # Splits left behind by an interrupted run are reused as long as they were made
+    # from the same source bytes, window and encoding
+    src = _open(split['image_uri'])
+    if not _is_current(split['uri'], split['fingerprint']):
+        tmp_uri = join('/tmp/', basename(split['uri']))
+        with _profiler.stage('write_split', split['uri']) as record:
+            _write_window(src, split['window'], tmp_uri, block_shape, encoding,
+                          _split_tags(split, split['fingerprint']), record,
+                          split['factor'])
+        _upload(tmp_uri, split['uri'])
+
+    # The scene's labels are rasterized onto the same grid as the split so that
+    # training and eval can read them like any other raster
+    if 'label_uri' in split and \
+            not _is_current(split['label_uri'], split['label_fingerprint']):
+        tmp_uri = join('/tmp/', basename(split['label_uri']))
+        with _profiler.stage('write_labels', split['label_uri']) as record:
+            _write_labels(src, split['window'], tmp_uri, split['label_source_uri'],
+                          _split_tags(split, split['label_fingerprint']), record,
+                          split['factor'])
+        _upload(tmp_uri, split['label_uri'])
+    return _profiler.drain()
+
+
+def split_image(image_uri, split_dir, block_size=1024, encoding=None, pool=None,
+                rasterize_labels=False, max_split_bytes=MAX_SPLIT_BYTES, overlap=0):
+    encoding = dict(DEFAULT_ENCODING, **(encoding or {}))
+    tiling = {'max_split_bytes': max_split_bytes, 'overlap': overlap}
+    area, image_id = _parse_image_uri(image_uri)
+    manifest_uri = get_manifest_uri(split_dir, area, image_id)
+    label_source_uri = _get_label_uri(image_uri) if rasterize_labels else None
+    map_fn = pool.map if pool else map
+
+    # Scenes that were already split from the same source (and labels) with the same
+    # encoding are left alone
+    with _profiler.stage('fingerprint', image_uri):
+        source = _source_fingerprint(image_uri)
+        label_source = _source_fingerprint(label_source_uri) if rasterize_labels else None
+        manifest = _load_manifest(manifest_uri)
+    if manifest and manifest.get('source') == source and \
+            manifest.get('labels') == label_source and \
+            manifest.get('encoding') == encoding and \
+            manifest.get('tiling', {}).get('max_split_bytes') == max_split_bytes and \
+            manifest.get('tiling', {}).get('overlap') == overlap:
+        return manifest
+
+    # Windows are as large as the memory budget allows and line up with the source's
+    # internal blocks
+    src = _open(image_uri)
+    grid = _block_grid(src)
+    win_size = _get_win_size(src, max_split_bytes)
+    wins = _get_windows(src.width, src.height, win_size, overlap, grid)
+    tiling.update({'win_size': win_size, 'grid': list(grid)})
+
+    # With a target GSD the splits are written at a coarser resolution. Blocks are kept
+    # to a multiple of the decimation factor so that they line up in the output.
+    factor = get_decimation(src, encoding['target_gsd'])
+    check_block_shape = _get_block_shape(block_size, grid)
+    write_block_shape = _get_block_shape(block_size, grid, factor)
+
+    # Split indices are assigned in window order after all of the nodata checks have
+    # finished so that a parallel run names its outputs exactly like a serial one
+    has_data = []
+    for keep, records in map_fn(_check_window,
+                                [(image_uri, win, check_block_shape) for win in wins]):
+        has_data.append(keep)
+        _profiler.extend(records)
+    kept = [win for win, keep in zip(wins, has_data) if keep]
+
+    # Splits keep their <id>_<n>.tif names, which existing configs and scene indexes
+    # refer to; the window itself is in the manifest and in each split's tags
+    splits = [{
+        'index': i,
+        'image_uri': image_uri,
+        'window': win,
+        'overlap': overlap,
+        'uri': join(split_dir, area, image_id, '{}_{}.tif'.format(image_id, i)),
+        'fingerprint': _window_fingerprint(source, win, encoding),
+        'factor': factor
+    } for i, win in enumerate(kept)]
+    if rasterize_labels:
+        for i, split in enumerate(splits):
+            split['label_source_uri'] = label_source_uri
+            split['label_uri'] = join(split_dir, area, image_id,
+                                      '{}_{}-labels.tif'.format(image_id, i))
+            split['label_fingerprint'] = _window_fingerprint(
+                {'image': source, 'labels': label_source}, split['window'],
+                dict(LABEL_ENCODING, target_gsd=encoding['target_gsd']))
+    for records in map_fn(_split_window,
+                          [(split, write_block_shape, encoding) for split in splits]):
+        _profiler.extend(records)
+
+    # Record every split in a manifest so that consumers can find them with a single
+    # read instead of probing for files
+    manifest = {
+        'image_uri': image_uri,
+        'source': source,
+        'labels': label_source,
+        'encoding': encoding,
+        'tiling': tiling,
+        'crs': src.crs.to_string() if src.crs else None,
+        'splits': [{
+            'index': split['index'],
+            'uri': split['uri'],
+            'label_uri': split.get('label_uri'),
+            'fingerprint': split['fingerprint'],
+            'label_fingerprint': split.get('label_fingerprint'),
+            'window': [split['window'].col_off, split['window'].row_off,
+                       split['window'].width, split['window'].height],
+            'overlap': overlap,
+            'decimation': factor,
+            'transform': list(_split_grid(src, split['window'], factor)[0])[:6],
+            'bounds': list(bounds(split['window'], src.transform))
+        } for split in splits]
+    }
+    with _profiler.stage('manifest', manifest_uri):
+        str_to_file(json.dumps(manifest, indent=2), manifest_uri)
+
+    _close(image_uri)
+    _drop_label_shapes(label_source_uri)
+    return manifest
 
 
 class PreProcessCommand(rv.AuxCommand):
@@ -76,8 +446,35 @@ class PreProcessCommand(rv.AuxCommand):
         required_fields=['items', 'split_dir'])
 
     def run(self):
+        block_size = self.command_config.get('block_size', 1024)
+        encoding = {k: self.command_config.get(k, v)
+                    for k, v in DEFAULT_ENCODING.items()}
+        num_workers = self.command_config.get('num_workers', 1)
+        rasterize_labels = self.command_config.get('rasterize_labels', False)
+        max_split_bytes = self.command_config.get('max_split_bytes', MAX_SPLIT_BYTES)
+        overlap = self.command_config.get('overlap', 0)
+        split_dir = self.command_config['split_dir']
+
+        _profiler.reset()
         for image_uri in self.command_config['items']:
-            split_image(image_uri, self.command_config['split_dir'])
+            # Each scene gets a fresh pool. The dataset handles and label shapes its
+            # workers cache are then released when the workers exit, instead of piling
+            # up for every scene of the job. The parent releases its own in split_image.
+            pool = Pool(num_workers) if num_workers > 1 else None
+            try:
+                split_image(image_uri, split_dir,
+                            block_size=block_size, encoding=encoding, pool=pool,
+                            rasterize_labels=rasterize_labels,
+                            max_split_bytes=max_split_bytes, overlap=overlap)
+            finally:
+                if pool:
+                    pool.close()
+                    pool.join()
+
+        # Stage timings are written next to the splits and summarized in the log
+        _profiler.save(join(split_dir, 'reports',
+                            report_name(PREPROCESS, self.command_config['items'])))
+        _profiler.print_summary(PREPROCESS)
 
     @staticmethod
     def gather_inputs(conf):
@@ -85,4 +482,5 @@ class PreProcessCommand(rv.AuxCommand):
 
     @staticmethod
     def gather_outputs(conf):
-        return ['.phony']
+        return [get_manifest_uri(conf['split_dir'], *_parse_image_uri(uri))
+                for uri in conf['items']]
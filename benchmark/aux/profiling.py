@@ -0,0 +1,108 @@
+import hashlib
+import json
+import resource
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+from rastervision.utils.files import str_to_file
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux. Children are included so that the peak of a
+    # worker pool is reported by the parent.
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(self_rss, children_rss) / 1024.0
+
+
+def current_rss_mb():
+    # Resident set size of this process right now. Unlike ru_maxrss this goes down as
+    # well as up, so it can be attributed to a single stage.
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * resource.getpagesize() / 1024.0 ** 2
+
+
+def report_name(command, items):
+    # Aux commands are split across instances so each split gets its own report
+    digest = hashlib.sha1(json.dumps(items).encode('utf-8')).hexdigest()[:12]
+    return '{}-{}.json'.format(command.lower(), digest)
+
+
+class Profiler():
+    # Records wall time, bytes read and written and RSS for each stage of each item.
+    # Each record holds the RSS when the stage finished and how much it grew while the
+    # stage ran (which includes other threads working at the same time). The process
+    # high-water mark is only reported for the run as a whole. Stages are cheap context
+    # managers so this can stay on in production.
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.records = []
+            self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, item=None):
+        record = {'stage': name, 'item': item, 'bytes_read': 0, 'bytes_written': 0}
+        start_rss = current_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            record['rss_mb'] = current_rss_mb()
+            record['rss_delta_mb'] = record['rss_mb'] - start_rss
+            with self._lock:
+                self.records.append(record)
+
+    def drain(self):
+        # Hand the records collected so far to another process
+        with self._lock:
+            records, self.records = self.records, []
+        return records
+
+    def extend(self, records):
+        with self._lock:
+            self.records.extend(records)
+
+    def summary(self):
+        stages = {}
+        for record in self.records:
+            stage = stages.setdefault(record['stage'], {
+                'count': 0, 'seconds': 0.0, 'bytes_read': 0, 'bytes_written': 0,
+                'max_rss_mb': 0.0, 'max_rss_delta_mb': 0.0
+            })
+            stage['count'] += 1
+            stage['seconds'] += record['seconds']
+            stage['bytes_read'] += record['bytes_read']
+            stage['bytes_written'] += record['bytes_written']
+            stage['max_rss_mb'] = max(stage['max_rss_mb'], record['rss_mb'])
+            stage['max_rss_delta_mb'] = max(stage['max_rss_delta_mb'],
+                                            record['rss_delta_mb'])
+        return stages
+
+    def report(self):
+        return {
+            'wall_seconds': time.perf_counter() - self.start,
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': self.summary(),
+            'records': self.records
+        }
+
+    def save(self, uri):
+        str_to_file(json.dumps(self.report(), indent=2), uri)
+
+    def print_summary(self, title):
+        report = self.report()
+        print('{}: {:.1f}s wall, {:.0f}MB peak RSS'.format(
+            title, report['wall_seconds'], report['peak_rss_mb']))
+        for name, stage in report['stages'].items():
+            print('  {:<14} {:>6} calls {:>9.1f}s {:>10.1f}MB read {:>10.1f}MB written '
+                  '{:>8.0f}MB max RSS {:>+8.0f}MB max growth'.format(
+                      name, stage['count'], stage['seconds'], stage['bytes_read'] / 1e6,
+                      stage['bytes_written'] / 1e6, stage['max_rss_mb'],
+                      stage['max_rss_delta_mb']))
@@ -0,0 +1,68 @@
+import os
+from os.path import basename, join, splitext
+
+import rasterio
+import rastervision as rv
+from benchmark.io import upload
+from benchmark.resolution import decimated_shape, decimated_transform, get_decimation
+from benchmark.utils import bounded_map, retry
+from rasterio.enums import Resampling
+
+RESAMPLE = 'RESAMPLE'
+
+
+def get_resampled_uri(output_dir, image_uri):
+    # Resampled chips keep the <id>/<id>.tif layout of the test set
+    chip_id = splitext(basename(image_uri))[0]
+    return join(output_dir, chip_id, '{}.tif'.format(chip_id))
+
+
+def resample_image(image_uri, output_uri, target_gsd, tmp_dir='/opt/data/resample/'):
+    # A decimated read lets GDAL pull from the chip's overviews when it has them
+    with rasterio.open(image_uri) as src:
+        factor = get_decimation(src, target_gsd)
+        height, width = decimated_shape(src.height, src.width, factor)
+        profile = src.profile.copy()
+        profile.update(height=height, width=width,
+                       transform=decimated_transform(src.transform, src.height,
+                                                     src.width, factor))
+        img = src.read(out_shape=(src.count, height, width),
+                       resampling=Resampling.average)
+
+    tmp_uri = join(tmp_dir, basename(output_uri))
+    os.makedirs(tmp_dir, exist_ok=True)
+    with rasterio.open(tmp_uri, 'w', **profile) as dst:
+        dst.write(img)
+    upload(tmp_uri, output_uri)
+    if tmp_uri != output_uri:
+        os.remove(tmp_uri)
+
+
+class ResampleCommand(rv.AuxCommand):
+    command_type = RESAMPLE
+    options = rv.AuxCommandOptions(
+        split_on='uris',
+        inputs=lambda conf: ResampleCommand.gather_inputs(conf),
+        outputs=lambda conf: ResampleCommand.gather_outputs(conf),
+        required_fields=['uris', 'output_dir', 'target_gsd'])
+
+    def run(self):
+        output_dir = self.command_config['output_dir']
+        target_gsd = self.command_config['target_gsd']
+        num_workers = self.command_config.get('num_workers', 16)
+        attempts = self.command_config.get('attempts', 3)
+
+        def process(uri):
+            output_uri = get_resampled_uri(output_dir, uri)
+            retry(lambda: resample_image(uri, output_uri, target_gsd), attempts)
+
+        for _ in bounded_map(process, self.command_config['uris'], num_workers):
+            pass
+
+    @staticmethod
+    def gather_inputs(conf):
+        return conf['uris']
+
+    @staticmethod
+    def gather_outputs(conf):
+        return [get_resampled_uri(conf['output_dir'], uri) for uri in conf['uris']]
@@ -0,0 +1,132 @@
+import io
+import os
+import tarfile
+from os.path import basename, join, splitext
+from urllib.parse import urlparse
+
+import numpy as np
+
+import rasterio
+import rastervision as rv
+from benchmark.aux.postprocess import get_reference_uri, make_lut, read_remapped
+from benchmark.constants import SUBMISSION_VALUES
+from benchmark.io import download, my_read_method, my_write_method, upload
+from benchmark.stac import iter_items
+from benchmark.utils import bounded_map, retry
+from pystac import STAC_IO, Catalog
+from rasterio.io import MemoryFile
+from rasterio.warp import transform_bounds
+
+SUBMISSION = 'SUBMISSION'
+
+
+def _load_test_bboxes(test_stac_uri):
+    STAC_IO.read_text_method = my_read_method
+    STAC_IO.write_text_method = my_write_method
+    return {item.id: item.bbox
+            for item in iter_items(Catalog.from_file(test_stac_uri))}
+
+
+def _validate(chip_id, img, src, bbox, chip_shape):
+    if bbox is None:
+        raise ValueError('{} is not an item in the test catalog'.format(chip_id))
+    if img.dtype != np.uint8 or img.shape != (1, ) + tuple(chip_shape):
+        raise ValueError('{} has shape {} and dtype {}, expected {} and uint8'.format(
+            chip_id, img.shape, img.dtype, (1, ) + tuple(chip_shape)))
+    invalid = set(np.unique(img)) - set(SUBMISSION_VALUES.values())
+    if invalid:
+        raise ValueError('{} contains invalid values {}'.format(chip_id, sorted(invalid)))
+
+    # Predictions inherit the georeferencing of their test chip so their footprint
+    # should line up with the item's bbox to within a pixel
+    chip_bbox = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
+    tolerance = max((bbox[2] - bbox[0]) / chip_shape[1],
+                    (bbox[3] - bbox[1]) / chip_shape[0])
+    if not np.allclose(chip_bbox, bbox, atol=tolerance):
+        raise ValueError('{} has bounds {} but its test item has bbox {}'.format(
+            chip_id, chip_bbox, bbox))
+
+
+def _package_chip(pred_uri, tmp_dir, lut, bboxes, chip_shape, reference_dir=None):
+    chip_id = splitext(basename(pred_uri))[0]
+    local = urlparse(pred_uri).scheme in ('', 'file')
+    src_uri = pred_uri if local else download(pred_uri, join(tmp_dir, basename(pred_uri)))
+
+    # Test chips are small enough to remap in a single read
+    with rasterio.open(src_uri) as src:
+        if reference_dir:
+            with rasterio.open(get_reference_uri(reference_dir, pred_uri)) as reference:
+                img, profile = read_remapped(src, lut, reference)
+        else:
+            img, profile = read_remapped(src, lut)
+
+    with MemoryFile() as mem:
+        with mem.open(**profile) as dst:
+            dst.write(img)
+            _validate(chip_id, img, dst, bboxes.get(chip_id), chip_shape)
+        data = mem.read()
+
+    if not local:
+        os.remove(src_uri)
+    return chip_id, data
+
+
+def package_submission(pred_uris, test_stac_uri, output_uri, num_workers=16,
+                       attempts=3, chip_shape=(1024, 1024), remap=True,
+                       require_all=True, reference_dir=None):
+    tmp_dir = '/opt/data/submission/'
+    os.makedirs(tmp_dir, exist_ok=True)
+    bboxes = _load_test_bboxes(test_stac_uri)
+    lut = make_lut() if remap else np.arange(256, dtype=np.uint8)
+
+    def package(uri):
+        return retry(lambda: _package_chip(uri, tmp_dir, lut, bboxes, chip_shape,
+                                           reference_dir),
+                     attempts)
+
+    # Chips are remapped and validated concurrently but written to the archive in
+    # order as they come back, so only a handful are ever held in memory
+    archive_uri = join(tmp_dir, basename(output_uri))
+    seen = set()
+    with tarfile.open(archive_uri, 'w:gz') as archive:
+        for chip_id, data in bounded_map(package, pred_uris, num_workers):
+            info = tarfile.TarInfo('{}.tif'.format(chip_id))
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+            seen.add(chip_id)
+
+    missing = set(bboxes) - seen
+    if require_all and missing:
+        raise ValueError('{} test items have no prediction, e.g. {}'.format(
+            len(missing), sorted(missing)[:5]))
+
+    upload(archive_uri, output_uri)
+    if archive_uri != output_uri:
+        os.remove(archive_uri)
+
+
+class SubmissionCommand(rv.AuxCommand):
+    command_type = SUBMISSION
+    options = rv.AuxCommandOptions(
+        inputs=lambda conf: SubmissionCommand.gather_inputs(conf),
+        outputs=lambda conf: SubmissionCommand.gather_outputs(conf),
+        required_fields=['uris', 'test_stac_uri', 'output_uri'])
+
+    def run(self):
+        package_submission(self.command_config['uris'],
+                           self.command_config['test_stac_uri'],
+                           self.command_config['output_uri'],
+                           num_workers=self.command_config.get('num_workers', 16),
+                           attempts=self.command_config.get('attempts', 3),
+                           chip_shape=self.command_config.get('chip_shape', (1024, 1024)),
+                           remap=self.command_config.get('remap', True),
+                           require_all=self.command_config.get('require_all', True),
+                           reference_dir=self.command_config.get('reference_dir'))
+
+    @staticmethod
+    def gather_inputs(conf):
+        return conf['uris']
+
+    @staticmethod
+    def gather_outputs(conf):
+        return [conf['output_uri']]
@@ -3,6 +3,13 @@ CLASSES = {
     'Building': (1, '#e6194b')
 }
 
+# Pixel values expected by the competition for each class. 0 is reserved for nodata in
+# rv so predictions use the ids in CLASSES and get remapped to these in POSTPROCESS.
+SUBMISSION_VALUES = {
+    'No Building': 0,
+    'Building': 1
+}
+
 TRAIN_IDS = [('mon', '401175'),
              ('acc', 'd41d81'),
              ('dar', 'a017f9'),
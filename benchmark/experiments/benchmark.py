@@ -1,15 +1,20 @@
 import json
 from functools import reduce
 from os.path import basename, dirname, join
-from random import sample
+from random import Random
 
 import rastervision as rv
+from benchmark.aux.preprocess import get_manifest_uri
+from benchmark.aux.resample import get_resampled_uri
 from benchmark.constants import CLASSES, TRAIN_IDS, VALID_IDS
-from benchmark.io import my_read_method, my_write_method
-from benchmark.utils import str_to_bool
+from benchmark.io import my_read_method, my_write_method, set_stac_cache_dir
+from benchmark.scene_index import (decode_fingerprints, decode_row, index_dir,
+                                   load_scene_index, select_rows)
+from benchmark.stac import iter_items
+from benchmark.utils import dataset_chip_key, str_to_bool
 from pystac import STAC_IO, Catalog
 from rastervision.backend.api import PYTORCH_SEMANTIC_SEGMENTATION
-from rastervision.utils.files import file_exists
+from rastervision.utils.files import file_to_str
 
 STAC_IO.read_text_method = my_read_method
 STAC_IO.write_text_method = my_write_method
@@ -23,26 +28,56 @@ class BenchmarkExperiment(rv.ExperimentSet):
                       test_stac_uri,
                       train_img_dir=None,
                       test_img_dir=None,
+                      stac_cache_dir=None,
+                      stac_workers=16,
+                      scene_index_uri=None,
+                      skip_test_scenes=False,
+                      label_aware_chips=False,
+                      min_valid_fraction=0.5,
+                      background_ratio=1.0,
+                      target_gsd=None,
+                      batch_predict=False,
+                      fused_postprocess=False,
+                      shared_chips=False,
                       test=False):
 
         # Parse 'test' option
         test = str_to_bool(test)
+        skip_test_scenes = str_to_bool(skip_test_scenes)
+        label_aware_chips = str_to_bool(label_aware_chips)
+        target_gsd = float(target_gsd) if target_gsd else None
+        fused_postprocess = str_to_bool(fused_postprocess)
+        # Fusing the postprocessing into prediction is done by BATCH_PREDICT
+        batch_predict = str_to_bool(batch_predict) or fused_postprocess
+        shared_chips = str_to_bool(shared_chips)
+
+        # Experiments that share chips have to pick the same splits, so their random
+        # choices are seeded
+        rng = Random(0 if shared_chips else None)
+
+        # STAC json read from s3 can be cached on disk so that rebuilding this config
+        # only revalidates the catalog files instead of downloading them again
+        if stac_cache_dir:
+            set_stac_cache_dir(stac_cache_dir)
 
         # Define split image directory: defaults to a directory called 'split_images'
         # within the root directory
         if not train_img_dir:
             train_img_dir = join(root_uri, 'split_images')
 
-        # This example uses scenes from the tier 1 training data for training and
-        # evaluation. Load in the tier 1 data using pystac:
-        train_stac = Catalog.from_file(train_stac_uri)
+        # Instead of reading the split manifests and the test STAC every time this config
+        # is built, you can point to a scene index created once with
+        # `python -m benchmark.scene_index`. It is a column store of the id, raster uri,
+        # label uri, fingerprints and bounds of every split and test chip, and only the
+        # columns the experiment needs are read from it.
+        scene_index = load_scene_index(scene_index_uri) if scene_index_uri else None
 
         # Use the set of train and validation scene ids that are defined in constants.py
         train_ids = TRAIN_IDS
         valid_ids = VALID_IDS
         if test:
-            train_ids = sample(train_ids, 2)
-            valid_ids = sample(valid_ids, 2)
+            train_ids = rng.sample(train_ids, 2)
+            valid_ids = rng.sample(valid_ids, 2)
 
         # For this experiment, we are interested in making predictions on two different
         # sets of images:
@@ -53,39 +88,26 @@ class BenchmarkExperiment(rv.ExperimentSet):
         #      model evaluation because we don't have the labels for them. Instead, we
         #      will submit the test set predictions to the competition site.
         #
-        # We will need to make scenes for each of the 11,481 test chips. It is possible
-        # to do this by reading the test STAC directly from s3 but it is not recommended.
-        # A better option would be to download the test data from the competition site
-        # and uncompress it into the data directory in this repo. That directory will
-        # mount into `/opt/data/` within the docker container and then you can supply
-        # uri for the test catalog json as the `test_stac_uri` parameter of this experiment
-        # runner (i.e. `/opt/data/test/catalog.json`).
+        # We will need to make scenes for each of the 11,481 test chips. The item json for
+        # each chip is read concurrently by `stac_workers` threads (see benchmark/stac.py)
+        # so the test STAC can be read directly from s3. If you have downloaded the test
+        # data from the competition site and uncompressed it into the data directory in
+        # this repo, that directory will mount into `/opt/data/` within the docker
+        # container and you can instead supply the uri for the local test catalog json
+        # as the `test_stac_uri` parameter of this experiment runner (i.e.
+        # `/opt/data/test/catalog.json`).
         #
         # It may make sense to start with a work flow in which you hold off on making
         # predictions on the test set until you have tried several approaches and validated
         # evaluated them against the validation set. If you would like to do that you can
-        # simply remove the `.with_test_scenes()` call from the dataset config builder as well
-        # as previous steps that deal with test data.
-
-        # Create a generator of all test images
-        test_stac = Catalog.from_file(test_stac_uri)
-        all_test_items = test_stac.get_all_items()
-
-        # By default, this script will look for test images in the file tree starting at
-        # the location of the test STAC catalog. However, in this example we want to access
-        # the catalog json and the images from different locations. As mentioned above, in the
-        # interest of time we will get all test ids from a local version of the test STAC but
-        # will still need to download the images directly from s3 since the prediction will
-        # run remotely. We will use a different location by setting the `test_img_dir`
-        # command line parameter to the poblic location of the test data on s3 (i.e.
-        # -a test_img_dir s3://drivendata-competition-building-segmentation/test/)
-        if not test_img_dir:
-            test_img_dir = dirname(test_stac_uri)
+        # use the `skip_test_scenes` option (i.e. `-a skip_test_scenes True`), which leaves
+        # the test scenes and the steps that deal with test data out of the experiment.
 
         # Configure chip creation
+        chip_size = 300
         chip_opts = {
             'window_method': 'sliding',  # use sliding window method of to create chips
-            'stride': 300               # slide over 300px to generate each new chip
+            'stride': chip_size         # slide over 300px to generate each new chip
         }
 
         # Training configuration: try to improve performance by tuning these
@@ -114,87 +136,136 @@ class BenchmarkExperiment(rv.ExperimentSet):
                 'chips_per_scene': 10
             }
 
-            # Convert the generator of all items (i.e. chips) within the test set into
-            # a list of only five
-            all_test_items = [next(all_test_items) for _ in range(5)]
-
             # Modify the experiment ID so that a future iteration of this same experiment
             # without the 'test' flag will not rely on the same outputs
             experiment_id += '-TEST'
 
+        # By default, this script will look for test images in the file tree starting at
+        # the location of the test STAC catalog. However, in this example we want to access
+        # the catalog json and the images from different locations. As mentioned above, in the
+        # interest of time we will get all test ids from a local version of the test STAC but
+        # will still need to download the images directly from s3 since the prediction will
+        # run remotely. We will use a different location by setting the `test_img_dir`
+        # command line parameter to the poblic location of the test data on s3 (i.e.
+        # -a test_img_dir s3://drivendata-competition-building-segmentation/test/)
+        if not test_img_dir:
+            test_img_dir = dirname(test_stac_uri)
+
+        # The uris in a scene index were fixed when it was built, so it can't be used
+        # with image directories other than the ones it was built from
+        if scene_index is not None:
+            img_dirs = [('train_img_dir', train_img_dir)]
+            if not skip_test_scenes:
+                img_dirs.append(('test_img_dir', test_img_dir))
+            for name, img_dir in img_dirs:
+                built_dir = index_dir(scene_index, name)
+                if built_dir and built_dir.rstrip('/') != img_dir.rstrip('/'):
+                    raise ValueError(
+                        'The scene index was built with {0} {1} but the experiment uses '
+                        '{0} {2}; rebuild the index or pass the same {0}'.format(
+                            name, built_dir, img_dir))
+
+        # Create a generator of (id, raster uri) pairs for all test images
+        def get_test_specs():
+            if scene_index is not None:
+                for row in select_rows(scene_index, 'test'):
+                    yield decode_row(row)[:2]
+            else:
+                test_stac = Catalog.from_file(test_stac_uri)
+                for item in iter_items(test_stac, num_workers=int(stac_workers)):
+                    yield item.id, join(test_img_dir, item.id, '{}.tif'.format(item.id))
+
         # Rastervision stores information about images and often their associted labels in
-        # SceneConfig objects. We will use this function to created lists of train and
-        # validation scenes from pystac items.
-        def make_train_scenes(item):
-            # We can easily construct the uri using the root directory of the training STAC.
-            # Each rv scene will consist of one portion of an image created in the preprocessing
-            # stage but it is not necessary to split the labels up in the same way. We can
-            # pass a scene's label uri to all of it's child images and rv will subset the
-            # labels automatically.
-            area = item.get_parent().id
+        # SceneConfig objects. Each rv scene will consist of one portion of an image created
+        # in the preprocessing stage. We first collect the (id, raster uri, label uri) of
+        # every split of a training scene and only build SceneConfigs for the ones we use.
+        #
+        # The fingerprints PREPROCESS gave each split (and its label raster) are kept
+        # alongside, so that chips shared between experiments are only reused while the
+        # splits they were made from are unchanged.
+        split_fingerprints = {}
+
+        def get_split_specs(area, image_id):
+            if scene_index is not None:
+                rows = select_rows(scene_index, 'split', [image_id])
+                for row in rows:
+                    split_fingerprints[decode_row(row)[0]] = decode_fingerprints(row)
+                return [decode_row(row) for row in rows]
+
+            # We can easily construct the label uri using the root directory of the training
+            # STAC. It is not necessary to split the labels up in the same way as the images.
+            # We can pass a scene's label uri to all of it's child images and rv will subset
+            # the labels automatically.
             label_uri = join(dirname(train_stac_uri), area,
-                             '{}-labels'.format(item.id), '{}.geojson'.format(item.id))
-
-            # If you preprocessed the imagery using the 'PREPROCESS' aux command, the
-            # image splits will have integer suffixes that ascend from 0 until the image
-            # has been completely covered. To make sure we get all of the splits we will
-            # incrementally create new uri's until one is found to not exist.
-            i = 0
-            images_remaining = True
-            scenes = []
-            while images_remaining:
-                raster_uri = join(train_img_dir, area, item.id,
-                                  '{}_{}.tif'.format(item.id, i))
-
-                if file_exists(raster_uri):
-                    # construct a raster source (i.e. the image)
-                    raster_source = rv.RasterSourceConfig.builder(rv.RASTERIO_SOURCE) \
-                        .with_uri(raster_uri) \
-                        .with_channel_order([0, 1, 2]) \
-                        .build()
-
-                    # construct a label source (i.e. the scene's geojson labels)
-                    # The with_rasterizer_options method sets the default pixel value to use
-                    # for background pixels in prediction. The value of 0 is reserved for nodata
-                    # pixels in rv so we will need to add a postprocessing step at the end
-                    # in order for the test set predicitons to match the competition submission
-                    # suidelines.
-                    label_raster_source = rv.RasterSourceConfig.builder(rv.RASTERIZED_SOURCE) \
-                        .with_vector_source(label_uri) \
-                        .with_rasterizer_options(2) \
-                        .build()
-
-                    label_source = rv.LabelSourceConfig.builder(rv.SEMANTIC_SEGMENTATION) \
-                        .with_raster_source(label_raster_source) \
-                        .build()
-
-                    # Build scene config
-                    scene = rv.SceneConfig.builder() \
-                        .with_task(task) \
-                        .with_id('{}_{}'.format(item.id, i)) \
-                        .with_raster_source(raster_source) \
-                        .with_label_source(label_source) \
-                        .build()
-
-                    scenes.append(scene)
-                else:
-                    images_remaining = False
-                i += 1
-
-            return scenes
+                             '{}-labels'.format(image_id), '{}.geojson'.format(image_id))
+
+            # If you preprocessed the imagery using the 'PREPROCESS' aux command, each scene
+            # will have a manifest json next to its image splits that lists the uri, window
+            # and bounds of every split. Reading it gets us all of the splits at once.
+            #
+            # If the labels were also rasterized during preprocessing (the default), each
+            # split has its own label raster on the same grid and we use that instead.
+            manifest = json.loads(file_to_str(get_manifest_uri(train_img_dir, area, image_id)))
+            for split in manifest['splits']:
+                split_fingerprints['{}_{}'.format(image_id, split['index'])] = (
+                    split['fingerprint'], split.get('label_fingerprint') or '')
+            return [('{}_{}'.format(image_id, split['index']), split['uri'],
+                     split.get('label_uri') or label_uri)
+                    for split in manifest['splits']]
+
+        def make_split_scene(scene_id, raster_uri, label_uri, aoi_uri=None):
+            # construct a raster source (i.e. the image)
+            raster_source = rv.RasterSourceConfig.builder(rv.RASTERIO_SOURCE) \
+                .with_uri(raster_uri) \
+                .with_channel_order([0, 1, 2]) \
+                .build()
+
+            # construct a label source (i.e. the scene's geojson labels)
+            # The with_rasterizer_options method sets the default pixel value to use
+            # for background pixels in prediction. The value of 0 is reserved for nodata
+            # pixels in rv so we will need to add a postprocessing step at the end
+            # in order for the test set predicitons to match the competition submission
+            # suidelines.
+            #
+            # Label rasters made by PREPROCESS already use those values and are read
+            # directly, which saves rv from parsing and rasterizing the geojson.
+            if label_uri.endswith('.tif'):
+                label_raster_source = rv.RasterSourceConfig.builder(rv.RASTERIO_SOURCE) \
+                    .with_uri(label_uri) \
+                    .build()
+            else:
+                label_raster_source = rv.RasterSourceConfig.builder(rv.RASTERIZED_SOURCE) \
+                    .with_vector_source(label_uri) \
+                    .with_rasterizer_options(2) \
+                    .build()
+
+            label_source = rv.LabelSourceConfig.builder(rv.SEMANTIC_SEGMENTATION) \
+                .with_raster_source(label_raster_source) \
+                .build()
+
+            # Build scene config
+            scene = rv.SceneConfig.builder() \
+                .with_task(task) \
+                .with_id(scene_id) \
+                .with_raster_source(raster_source) \
+                .with_label_source(label_source)
+
+            # Restrict chipping to the windows selected by the CHIP_INDEX command
+            if aoi_uri:
+                scene = scene.with_aoi_uris([aoi_uri])
+
+            return scene.build()
 
         # The test image chips are also encoded as SceneConfig objects but
         # lack a label source
-        def make_test_scene(item):
-            raster_uri = join(test_img_dir, item.id, '{}.tif'.format(item.id))
-
+        def make_test_scene(scene_id, raster_uri):
             raster_source = rv.RasterSourceConfig.builder(rv.RASTERIO_SOURCE) \
                 .with_uri(raster_uri) \
                 .with_channel_order([0, 1, 2]) \
                 .build()
 
             scene = rv.SceneConfig.builder() \
-                .with_id(item.id) \
+                .with_id(scene_id) \
                 .with_raster_source(raster_source) \
                 .build()
 
@@ -204,6 +275,7 @@ class BenchmarkExperiment(rv.ExperimentSet):
         # use the chipping options defined previously within this script
         task = rv.TaskConfig.builder(rv.SEMANTIC_SEGMENTATION) \
                             .with_classes(CLASSES) \
+                            .with_chip_size(chip_size) \
                             .with_chip_options(**chip_opts) \
                             .build()
 
@@ -218,26 +290,81 @@ class BenchmarkExperiment(rv.ExperimentSet):
 
         # Create train, validation and test scenes
         print('Creating train scenes')
-        train_scenes = reduce(
-            lambda a, b: a + b, [make_train_scenes(train_stac.get_child(c).get_item(i)) for c, i in train_ids])
+        train_specs = reduce(
+            lambda a, b: a + b, [get_split_specs(c, i) for c, i in train_ids])
 
         print('Creating validation scenes')
-        valid_scenes = reduce(
-            lambda a, b: a + b, [make_train_scenes(train_stac.get_child(c).get_item(i)) for c, i in valid_ids])
-        
+        valid_specs = reduce(
+            lambda a, b: a + b, [get_split_specs(c, i) for c, i in valid_ids])
+
         # Using four different scenes (from four different cities) for the validation
         # set is benefficial becuase it gives us a diverse set of imagery to use when 
         # determining the generalizability of the model. However, it would be overkill
         # to validate the model on the entirety of the four scenes. We will take a random
         # sample of those image splits and validate on those.
-        valid_scenes = sample(valid_scenes, 30)
-
-        print('Creating test scenes')
-        test_scenes = [make_test_scene(item) for item in all_test_items]
+        valid_specs = rng.sample(valid_specs, min(30, len(valid_specs)))
 
         if test:
-            train_scenes = sample(train_scenes, 3)
-            valid_scenes = sample(valid_scenes, 3)
+            train_specs = rng.sample(train_specs, min(3, len(train_specs)))
+            valid_specs = rng.sample(valid_specs, min(3, len(valid_specs)))
+
+        # Chips depend on the chip settings and the splits they are made from, not on the
+        # model or training options. With the `shared_chips` option the chip (and
+        # CHIP_INDEX) outputs are keyed by a hash of those instead of the experiment id,
+        # so a sweep over `model_arch`, `lr` or `num_epochs` chips the splits only once.
+        # Splits are rewritten in place when they are preprocessed again (e.g. with a
+        # different `target_gsd`), so their fingerprints are part of the key.
+        chip_key = dataset_chip_key(
+            chip_size,
+            dict(chip_opts, label_aware_chips=label_aware_chips,
+                 min_valid_fraction=float(min_valid_fraction),
+                 background_ratio=float(background_ratio)),
+            [('train', ) + spec + split_fingerprints[spec[0]] for spec in train_specs] +
+            [('valid', ) + spec + split_fingerprints[spec[0]] for spec in valid_specs])
+
+        # Many of the sliding windows over a split are mostly nodata or contain no
+        # buildings at all. With the `label_aware_chips` option, the 'CHIP_INDEX' aux command
+        # (aux/chip_index.py) measures the valid and building pixel coverage of every window
+        # of the training splits. It then writes an AOI that keeps windows which are at least
+        # `min_valid_fraction` valid, with at most `background_ratio` building-free windows
+        # for every window with buildings. Raster Vision only makes chips within the AOI.
+        chip_index_dir = join(root_uri, 'chip_index',
+                              chip_key if shared_chips else experiment_id)
+        if label_aware_chips:
+            train_specs = [spec + (join(chip_index_dir, '{}.geojson'.format(spec[0])), )
+                           for spec in train_specs]
+
+        train_scenes = [make_split_scene(*spec) for spec in train_specs]
+        valid_scenes = [make_split_scene(*spec) for spec in valid_specs]
+
+        test_specs = []
+        test_scenes = []
+        if not skip_test_scenes:
+            print('Creating test scenes')
+            test_specs = get_test_specs()
+            if test:
+                # Only use five of the chips within the test set
+                test_specs = [next(test_specs) for _ in range(5)]
+            test_specs = list(test_specs)
+
+            # The training splits can be written at a common, coarser resolution by passing
+            # `target_gsd` (in meters) to the split_images experiment. Pass the same value
+            # here and the 'RESAMPLE' aux command (aux/resample.py) will make copies of the
+            # test chips at that resolution to predict on. POSTPROCESS and SUBMISSION then
+            # bring the predictions back onto the grid of the original chips.
+            if target_gsd:
+                resampled_dir = join(root_uri, 'resampled', str(target_gsd))
+                native_test_uris = [uri for _, uri in test_specs]
+                test_specs = [(scene_id, get_resampled_uri(resampled_dir, uri))
+                              for scene_id, uri in test_specs]
+
+            # Predicting on each test chip as its own rv scene carries a lot of per scene
+            # overhead. With the `batch_predict` option the test chips are left out of the
+            # dataset and predicted by the 'BATCH_PREDICT' aux command (aux/batch_predict.py)
+            # instead, which loads the model once and batches windows from many chips into
+            # each forward pass. It writes to the same place as the predict command.
+            if not batch_predict:
+                test_scenes = [make_test_scene(*spec) for spec in test_specs]
 
         # and use them as inputs to an RV DatasetConfig
         print('Building dataset config')
@@ -262,13 +389,91 @@ class BenchmarkExperiment(rv.ExperimentSet):
             'POSTPROCESS': {
                 'key': 'postprocess',
                 'config': {
-                    'uris': [join(root_uri, 'predict', experiment_id, '{}.tif'.format(scene.id)) for scene in test_scenes],
+                    'uris': [join(root_uri, 'predict', experiment_id, '{}.tif'.format(scene_id)) for scene_id, _ in test_specs],
                     'root_uri': root_uri,
                     'experiment_id': experiment_id
                 }
             }
         }
 
+        # The 'SUBMISSION' aux command (aux/submission.py) goes one step further and
+        # packages the raw predictions straight into the archive that gets uploaded to the
+        # competition site. Each chip is remapped in the same way as in POSTPROCESS and
+        # checked against its item in the test STAC before being added to the archive.
+        postprocess_config['SUBMISSION'] = {
+            'key': 'submission',
+            'config': {
+                'uris': postprocess_config['POSTPROCESS']['config']['uris'],
+                'test_stac_uri': test_stac_uri,
+                'output_uri': join(root_uri, 'submission', experiment_id, 'submission.tgz'),
+                'require_all': not test
+            }
+        }
+
+        if batch_predict:
+            postprocess_config['BATCH_PREDICT'] = {
+                'key': 'batch_predict',
+                'config': {
+                    'uris': [uri for _, uri in test_specs],
+                    'bundle_uri': join(root_uri, 'bundle', experiment_id, 'predict_package.zip'),
+                    'output_dir': join(root_uri, 'predict', experiment_id)
+                }
+            }
+
+        # With the `fused_postprocess` option, BATCH_PREDICT applies the same class remapping
+        # as POSTPROCESS while it writes each prediction. The chips are written once, already
+        # in submission format, to the postprocess directory and the POSTPROCESS step is
+        # dropped. SUBMISSION packages those chips without remapping them again.
+        if fused_postprocess:
+            postprocess_dir = join(root_uri, 'postprocess', experiment_id)
+            postprocess_config['BATCH_PREDICT']['config'].update({
+                'output_dir': postprocess_dir,
+                'remap': True
+            })
+            postprocess_config['SUBMISSION']['config'].update({
+                'uris': [join(postprocess_dir, '{}.tif'.format(scene_id))
+                         for scene_id, _ in test_specs],
+                'remap': False
+            })
+            del postprocess_config['POSTPROCESS']
+
+        if target_gsd and test_specs:
+            if fused_postprocess:
+                postprocess_config['BATCH_PREDICT']['config']['reference_dir'] = test_img_dir
+            else:
+                postprocess_config['POSTPROCESS']['config']['reference_dir'] = test_img_dir
+                postprocess_config['SUBMISSION']['config']['reference_dir'] = test_img_dir
+            postprocess_config['RESAMPLE'] = {
+                'key': 'resample',
+                'config': {
+                    'uris': native_test_uris,
+                    'output_dir': resampled_dir,
+                    'target_gsd': target_gsd
+                }
+            }
+
+        # Without test scenes there is nothing to postprocess or submit
+        if skip_test_scenes:
+            postprocess_config = {}
+
+        if label_aware_chips:
+            postprocess_config['CHIP_INDEX'] = {
+                'key': 'chip_index',
+                'config': {
+                    'scenes': [{
+                        'id': scene_id,
+                        'raster_uri': raster_uri,
+                        'label_uri': label_uri,
+                        'aoi_uri': aoi_uri,
+                        'index_uri': join(chip_index_dir, '{}.json'.format(scene_id))
+                    } for scene_id, raster_uri, label_uri, aoi_uri in train_specs],
+                    'chip_size': chip_size,
+                    'stride': chip_opts.get('stride', chip_size),
+                    'min_valid_fraction': float(min_valid_fraction),
+                    'background_ratio': float(background_ratio)
+                }
+            }
+
         # Finally build an experiment from all of these constituent parts. Returning an
         # methods that have the prefix 'exp_' (like this one) will run reflexively when this
         # script is run.
@@ -278,8 +483,10 @@ class BenchmarkExperiment(rv.ExperimentSet):
             .with_backend(backend) \
             .with_dataset(dataset) \
             .with_root_uri(root_uri) \
-            .with_custom_config(postprocess_config) \
-            .build()
+            .with_custom_config(postprocess_config)
+        if shared_chips:
+            experiment = experiment.with_chip_key(chip_key)
+        experiment = experiment.build()
 
         # returning the experiment config will kick off the chain workflow if running locally
         # or submit the sequence of dependent jobs if running on batch
@@ -1,8 +1,9 @@
 from os.path import dirname, join
 
 import rastervision as rv
-from benchmark.aux.preprocess import PREPROCESS
+from benchmark.aux.preprocess import MAX_SPLIT_BYTES, PREPROCESS
 from benchmark.constants import TRAIN_IDS, VALID_IDS
+from benchmark.utils import str_to_bool
 from pystac import Catalog
 
 
@@ -10,7 +11,14 @@ class SplitImages(rv.ExperimentSet):
     def exp_split_images(self,
                          root_uri,
                          train_stac_uri='https://drivendata-competition-building-segmentation.s3-us-west-1.amazonaws.com/train_tier_1/catalog.json',
-                         split_dir=None):
+                         split_dir=None,
+                         compress='JPEG',
+                         jpeg_quality=100,
+                         num_workers=1,
+                         rasterize_labels=True,
+                         target_gsd=None,
+                         max_split_bytes=MAX_SPLIT_BYTES,
+                         overlap=0):
         
         if not split_dir:
             split_dir = join(root_uri, 'split_images')
@@ -22,6 +30,14 @@ class SplitImages(rv.ExperimentSet):
 
         config = rv.CommandConfig.builder(PREPROCESS) \
                                  .with_root_uri(root_uri) \
-                                 .with_config(items=image_uris, split_dir=split_dir) \
+                                 .with_config(items=image_uris,
+                                              split_dir=split_dir,
+                                              compress=compress,
+                                              jpeg_quality=int(jpeg_quality),
+                                              num_workers=int(num_workers),
+                                              rasterize_labels=str_to_bool(rasterize_labels),
+                                              target_gsd=float(target_gsd) if target_gsd else None,
+                                              max_split_bytes=int(max_split_bytes),
+                                              overlap=int(overlap)) \
                                  .build()
         return config
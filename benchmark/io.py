@@ -1,7 +1,83 @@
+import hashlib
+import json
+import os
+from os.path import dirname, isfile, join
+from threading import Lock
 from urllib.parse import urlparse
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from pystac import STAC_IO
+from rastervision.utils.files import download_if_needed, upload_or_copy
+
+S3_MAX_POOL_CONNECTIONS = 64
+
+_s3_client = None
+_s3_lock = Lock()
+
+# When set, STAC json read from s3 is kept on disk and revalidated with its ETag
+_stac_cache_dir = os.environ.get('BENCHMARK_STAC_CACHE_DIR')
+
+
+def get_s3_client():
+    # boto3 clients are thread safe once created but creating them is not, so a single
+    # client (and connection pool) is shared by every thread in the process
+    global _s3_client
+    with _s3_lock:
+        if _s3_client is None:
+            config = Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
+            _s3_client = boto3.session.Session().client('s3', config=config)
+    return _s3_client
+
+
+def download(uri, path):
+    parsed = urlparse(uri)
+    if parsed.scheme == 's3':
+        os.makedirs(dirname(path), exist_ok=True)
+        get_s3_client().download_file(parsed.netloc, parsed.path[1:], path)
+        return path
+    return download_if_needed(uri, dirname(path))
+
+
+def upload(path, uri):
+    parsed = urlparse(uri)
+    if parsed.scheme == 's3':
+        get_s3_client().upload_file(path, parsed.netloc, parsed.path[1:])
+    else:
+        upload_or_copy(path, uri)
+
+
+def set_stac_cache_dir(cache_dir):
+    global _stac_cache_dir
+    _stac_cache_dir = cache_dir
+
+
+def _read_s3_cached(bucket, key, uri):
+    cache_path = join(_stac_cache_dir,
+                      hashlib.sha1(uri.encode('utf-8')).hexdigest() + '.json')
+    cached = None
+    if isfile(cache_path):
+        with open(cache_path) as f:
+            cached = json.load(f)
+
+    # A conditional GET returns 304 when the cached copy is still current, so a cache
+    # hit costs one round trip and no body transfer
+    try:
+        kwargs = {'IfNoneMatch': cached['etag']} if cached else {}
+        obj = get_s3_client().get_object(Bucket=bucket, Key=key, **kwargs)
+    except ClientError as e:
+        if cached and e.response['Error']['Code'] in ('304', 'NotModified'):
+            return cached['text']
+        raise
+
+    text = obj['Body'].read().decode('utf-8')
+    os.makedirs(_stac_cache_dir, exist_ok=True)
+    tmp_path = '{}.{}'.format(cache_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump({'uri': uri, 'etag': obj['ETag'], 'text': text}, f)
+    os.replace(tmp_path, cache_path)
+    return text
 
 
 def my_read_method(uri):
@@ -9,9 +85,10 @@ def my_read_method(uri):
     if parsed.scheme == 's3':
         bucket = parsed.netloc
         key = parsed.path[1:]
-        s3 = boto3.resource('s3')
-        obj = s3.Object(bucket, key)
-        return obj.get()['Body'].read().decode('utf-8')
+        if _stac_cache_dir:
+            return _read_s3_cached(bucket, key, uri)
+        obj = get_s3_client().get_object(Bucket=bucket, Key=key)
+        return obj['Body'].read().decode('utf-8')
     else:
         return STAC_IO.default_read_text_method(uri)
 
@@ -21,7 +98,6 @@ def my_write_method(uri, txt):
     if parsed.scheme == 's3':
         bucket = parsed.netloc
         key = parsed.path[1:]
-        s3 = boto3.resource("s3")
-        s3.Object(bucket, key).put(Body=txt)
+        get_s3_client().put_object(Bucket=bucket, Key=key, Body=txt)
     else:
         STAC_IO.default_write_text_method(uri, txt)
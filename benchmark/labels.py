@@ -0,0 +1,30 @@
+import json
+
+import numpy as np
+
+from benchmark.constants import CLASSES
+from rasterio.crs import CRS
+from rasterio.features import rasterize
+from rasterio.warp import transform_geom
+from rastervision.utils.files import file_to_str
+
+# Label rasters use the rv class ids from constants.py
+BUILDING_VALUE = CLASSES['Building'][0]
+BACKGROUND_VALUE = CLASSES['No Building'][0]
+
+
+def load_label_shapes(label_uri, crs):
+    # Label geojson is in lat/lng; reproject the polygons into the raster's crs once so
+    # they can be burned into any window of that raster
+    geojson = json.loads(file_to_str(label_uri))
+    shapes = [f['geometry'] for f in geojson['features'] if f.get('geometry')]
+    if shapes and crs and CRS.from_user_input(crs) != CRS.from_epsg(4326):
+        shapes = transform_geom('EPSG:4326', crs, shapes)
+    return shapes
+
+
+def rasterize_labels(shapes, transform, shape, background=0):
+    if not shapes:
+        return np.full(shape, background, dtype=np.uint8)
+    return rasterize(((s, BUILDING_VALUE) for s in shapes), out_shape=shape,
+                     transform=transform, fill=background, dtype=np.uint8)
@@ -0,0 +1,42 @@
+import math
+
+from affine import Affine
+from rasterio.warp import transform as transform_coords
+
+METERS_PER_DEGREE = 111320.0
+
+
+def ground_resolution(src):
+    # Approximate size of a pixel on the ground in meters at the center of the raster
+    res = src.res[0]
+    if src.crs is None or not (src.crs.is_geographic or src.crs.to_epsg() == 3857):
+        return res
+
+    center = src.xy(src.height // 2, src.width // 2)
+    _, lats = transform_coords(src.crs, 'EPSG:4326', [center[0]], [center[1]])
+    scale = math.cos(math.radians(lats[0]))
+    if src.crs.is_geographic:
+        return res * METERS_PER_DEGREE * scale
+    return res * scale
+
+
+def get_decimation(src, target_gsd):
+    # Largest integer factor that keeps src's pixels at or below target_gsd, so they
+    # end up somewhere in (target_gsd / 2, target_gsd] rather than exactly at it. Scenes
+    # finer than twice the target keep their native resolution.
+    # The ratio is nudged up before flooring since exact ratios like 0.15 / 0.05 come
+    # out just under the integer in floating point.
+    if not target_gsd:
+        return 1
+    return max(1, int(math.floor(target_gsd / ground_resolution(src) + 1e-6)))
+
+
+def decimated_shape(height, width, factor):
+    return int(math.ceil(height / factor)), int(math.ceil(width / factor))
+
+
+def decimated_transform(transform, height, width, factor):
+    # For a single out_shape read of the whole raster, which GDAL stretches evenly over
+    # the output pixels
+    out_height, out_width = decimated_shape(height, width, factor)
+    return transform * Affine.scale(width / out_width, height / out_height)
@@ -0,0 +1,139 @@
+import argparse
+import json
+import os
+from os.path import basename, dirname, join
+
+import numpy as np
+
+from benchmark.aux.preprocess import get_manifest_uri
+from benchmark.constants import TRAIN_IDS, VALID_IDS
+from benchmark.io import my_read_method, my_write_method
+from benchmark.stac import iter_items
+from pystac import STAC_IO, Catalog
+from rastervision.utils.files import download_if_needed, file_to_str, upload_or_copy
+
+# One row per scene the experiment can use: an image split of a training scene or a
+# test chip. The index is stored column by column (one array per field in an npz) so
+# that a reader only loads the columns it uses.
+SCENE_INDEX_FIELDS = ['id', 'scene_id', 'group', 'raster_uri', 'label_uri', 'fingerprint',
+                      'label_fingerprint']
+
+# Fields that select_rows returns by default; the filter columns and bounds are left out
+ROW_FIELDS = ['id', 'raster_uri', 'label_uri', 'fingerprint', 'label_fingerprint']
+
+
+class _Columns(dict):
+    # Columns of a loaded index, each read from the npz the first time it is used
+    def __init__(self, npz):
+        super().__init__()
+        self.npz = npz
+        self.fields = npz.files
+
+    def __missing__(self, field):
+        self[field] = self.npz[field]
+        return self[field]
+
+
+def _split_rows(train_stac_uri, train_img_dir, image_ids):
+    for area, image_id in image_ids:
+        label_uri = join(dirname(train_stac_uri), area, '{}-labels'.format(image_id),
+                         '{}.geojson'.format(image_id))
+        manifest = json.loads(file_to_str(get_manifest_uri(train_img_dir, area, image_id)))
+        for split in manifest['splits']:
+            yield ('{}_{}'.format(image_id, split['index']), image_id, 'split',
+                   split['uri'], split.get('label_uri') or label_uri, split['fingerprint'],
+                   split.get('label_fingerprint') or '', split['bounds'])
+
+
+def _test_rows(test_stac_uri, test_img_dir, stac_workers):
+    test_stac = Catalog.from_file(test_stac_uri)
+    for item in iter_items(test_stac, num_workers=stac_workers):
+        yield (item.id, item.id, 'test', join(test_img_dir, item.id, '{}.tif'.format(item.id)),
+               '', '', '', item.bbox)
+
+
+def build_scene_index(train_stac_uri, test_stac_uri, train_img_dir, test_img_dir=None,
+                      image_ids=TRAIN_IDS + VALID_IDS, stac_workers=16):
+    rows = list(_split_rows(train_stac_uri, train_img_dir, image_ids))
+    if test_stac_uri:
+        if not test_img_dir:
+            test_img_dir = dirname(test_stac_uri)
+        rows += list(_test_rows(test_stac_uri, test_img_dir, stac_workers))
+
+    # Byte string columns are as wide as their longest value so nothing is truncated
+    index = {field: np.array([row[i].encode('utf-8') for row in rows], dtype='S')
+             for i, field in enumerate(SCENE_INDEX_FIELDS)}
+    index['bounds'] = np.array([row[-1] for row in rows], dtype='f8').reshape(-1, 4)
+
+    # The directories the uris were built from, so that an experiment can tell when it
+    # is pointed somewhere else
+    index['train_img_dir'] = np.array(train_img_dir.encode('utf-8'))
+    index['test_img_dir'] = np.array((test_img_dir or '').encode('utf-8'))
+    return index
+
+
+def save_scene_index(index, uri, tmp_dir='/tmp/'):
+    path = join(tmp_dir, basename(uri))
+    with open(path, 'wb') as f:
+        np.savez(f, **index)
+    upload_or_copy(path, uri)
+    if path != uri:
+        os.remove(path)
+
+
+def load_scene_index(uri, tmp_dir='/opt/data/scene-index/'):
+    # Nothing is read until a column is used
+    return _Columns(np.load(download_if_needed(uri, tmp_dir)))
+
+
+def index_dir(index, name):
+    return index[name].item().decode('utf-8')
+
+
+def select_rows(index, group, scene_ids=None, fields=ROW_FIELDS):
+    # Rows are found with the group and scene id columns, then only the requested
+    # fields of the matching rows are gathered into a structured array
+    mask = index['group'] == group.encode('utf-8')
+    if scene_ids is not None:
+        mask &= np.isin(index['scene_id'], [s.encode('utf-8') for s in scene_ids])
+    fields = [field for field in fields if field in index.fields]
+    rows = np.empty(int(mask.sum()), dtype=[(field, index[field].dtype) for field in fields])
+    for field in fields:
+        rows[field] = index[field][mask]
+    return rows
+
+
+def decode_row(row):
+    return (row['id'].decode('utf-8'), row['raster_uri'].decode('utf-8'),
+            row['label_uri'].decode('utf-8'))
+
+
+def decode_fingerprints(row):
+    # Indexes built before the fingerprints were recorded don't have these fields
+    return tuple(row[field].decode('utf-8') if field in row.dtype.names else ''
+                 for field in ('fingerprint', 'label_fingerprint'))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the scene index used by the benchmark experiment')
+    parser.add_argument('output_uri')
+    parser.add_argument('--train_stac_uri', required=True)
+    parser.add_argument('--test_stac_uri')
+    parser.add_argument('--train_img_dir', required=True)
+    parser.add_argument('--test_img_dir')
+    parser.add_argument('--stac_workers', type=int, default=16)
+    args = parser.parse_args()
+
+    STAC_IO.read_text_method = my_read_method
+    STAC_IO.write_text_method = my_write_method
+
+    index = build_scene_index(args.train_stac_uri, args.test_stac_uri, args.train_img_dir,
+                              test_img_dir=args.test_img_dir,
+                              stac_workers=args.stac_workers)
+    save_scene_index(index, args.output_uri)
+    print('Wrote {} scenes to {}'.format(len(index['id']), args.output_uri))
+
+
+if __name__ == '__main__':
+    main()
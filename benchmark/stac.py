@@ -0,0 +1,22 @@
+from benchmark.utils import bounded_map
+from pystac import Item
+
+
+def _resolve_item(link):
+    if not isinstance(link.target, str):
+        return link.target
+    return Item.from_file(link.get_absolute_href())
+
+
+def _item_links(catalog):
+    for link in catalog.get_links('item'):
+        yield link
+    for child in catalog.get_children():
+        yield from _item_links(child)
+
+
+def iter_items(catalog, num_workers=16):
+    # Equivalent to catalog.get_all_items() except that item json is read by a bounded
+    # pool of threads. Items are yielded in catalog order as soon as they arrive.
+    return bounded_map(_resolve_item, _item_links(catalog), num_workers,
+                       max_pending=4 * num_workers)
@@ -0,0 +1,280 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import time
+from multiprocessing import get_context
+from os.path import basename, dirname, isfile, join, splitext
+
+import numpy as np
+
+import rasterio
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+# Synthetic scenes are georeferenced like the training orthos: UTM with ~5cm pixels
+SYNTHETIC_CRS = 'EPSG:32737'
+SYNTHETIC_RES = 0.05
+TILE_SIZE = 1024
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _percentiles(latencies):
+    if not latencies:
+        return {}
+    return {'p{}'.format(p): float(np.percentile(latencies, p)) for p in (50, 90, 99)}
+
+
+def make_scene(uri, size, nodata_fraction, seed):
+    # RGBA scene written one tile at a time. Like the footprint edges of the real orthos,
+    # nodata is one contiguous band: the leftmost nodata_fraction of the columns are
+    # zero with alpha 0. Split windows that fall entirely in the band are skipped by
+    # PREPROCESS, so the band has to be at least one window wide to exercise that path.
+    rng = np.random.RandomState(seed)
+    band = int(round(nodata_fraction * size))
+    profile = {
+        'driver': 'GTiff', 'dtype': 'uint8', 'count': 4, 'height': size, 'width': size,
+        'crs': SYNTHETIC_CRS, 'transform': from_origin(500000, 9300000, SYNTHETIC_RES,
+                                                      SYNTHETIC_RES),
+        'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'DEFLATE',
+        'photometric': 'RGB', 'alpha': 'YES', 'BIGTIFF': 'YES'
+    }
+    with rasterio.open(uri, 'w', **profile) as dst:
+        for row in range(0, size, TILE_SIZE):
+            for col in range(0, size, TILE_SIZE):
+                win = Window(col, row, min(TILE_SIZE, size - col), min(TILE_SIZE, size - row))
+                tile = rng.randint(0, 256, (4, win.height, win.width), dtype=np.uint8)
+                tile[3] = 255
+                tile[:, :, :max(0, min(band - col, win.width))] = 0
+                dst.write(tile, window=win)
+
+
+def make_chips(chip_dir, num_chips, seed):
+    # Raw predictions in rv class ids, like the output of the predict command
+    rng = np.random.RandomState(seed)
+    os.makedirs(chip_dir, exist_ok=True)
+    profile = {
+        'driver': 'GTiff', 'dtype': 'uint8', 'count': 1, 'height': 1024, 'width': 1024,
+        'crs': SYNTHETIC_CRS, 'transform': from_origin(500000, 9300000, SYNTHETIC_RES,
+                                                      SYNTHETIC_RES)
+    }
+    uris = []
+    for i in range(num_chips):
+        uri = join(chip_dir, 'chip{:05d}.tif'.format(i))
+        if not isfile(uri):
+            with rasterio.open(uri, 'w', **profile) as dst:
+                dst.write(rng.randint(1, 3, (1, 1024, 1024), dtype=np.uint8))
+        uris.append(uri)
+    return uris
+
+
+def run_preprocess(scene_uri, work_dir, num_workers):
+    from multiprocessing import Pool
+    from benchmark.aux import preprocess
+
+    # Splits are rewritten on every run; a leftover manifest would skip the scene
+    split_dir = join(work_dir, 'split_images')
+    shutil.rmtree(split_dir, ignore_errors=True)
+
+    pool = Pool(num_workers) if num_workers > 1 else None
+    preprocess._profiler.reset()
+    start = time.perf_counter()
+    try:
+        manifest = preprocess.split_image(scene_uri, split_dir, pool=pool)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    seconds = time.perf_counter() - start
+
+    with rasterio.open(scene_uri) as src:
+        megapixels = src.width * src.height / 1e6
+    report = preprocess._profiler.report()
+    latencies = [r['seconds'] for r in report['records'] if r['stage'] == 'write_split']
+    return {
+        'seconds': seconds,
+        'megapixels': megapixels,
+        'mp_per_second': megapixels / seconds,
+        'splits': len(manifest['splits']),
+        'empty_windows': sum(r['stage'] == 'nodata_check' for r in report['records']) -
+        len(manifest['splits']),
+        'split_latency_seconds': _percentiles(latencies),
+        'stages': report['stages'],
+        'peak_rss_mb': report['peak_rss_mb']
+    }
+
+
+def run_postprocess(chip_uris, work_dir, num_workers):
+    from benchmark.aux.postprocess import _postprocess, make_lut
+    from benchmark.aux.profiling import Profiler
+    from benchmark.utils import bounded_map
+
+    shutil.rmtree(join(work_dir, 'postprocess'), ignore_errors=True)
+    lut = make_lut()
+    profiler = Profiler()
+
+    def process(uri):
+        start = time.perf_counter()
+        _postprocess(uri, 'throughput', work_dir, lut, profiler)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = list(bounded_map(process, chip_uris, num_workers))
+    seconds = time.perf_counter() - start
+
+    megapixels = len(chip_uris) * 1024 * 1024 / 1e6
+    report = profiler.report()
+    return {
+        'seconds': seconds,
+        'files': len(chip_uris),
+        'files_per_second': len(chip_uris) / seconds,
+        'mp_per_second': megapixels / seconds,
+        'chip_latency_seconds': _percentiles(latencies),
+        'stages': report['stages'],
+        'peak_rss_mb': report['peak_rss_mb']
+    }
+
+
+def check_fused(chip_uri, work_dir):
+    # BATCH_PREDICT's fused write has to produce the same chip as POSTPROCESS does from
+    # the same raw prediction, both on the chip's own grid and when the prediction was
+    # made at half resolution and is brought back onto the original chip
+    from benchmark.aux.batch_predict import _write_prediction
+    from benchmark.aux.postprocess import _postprocess, get_reference_uri, make_lut
+    from benchmark.aux.profiling import Profiler
+
+    check_dir = join(work_dir, 'fused-check')
+    shutil.rmtree(check_dir, ignore_errors=True)
+    chip_id = splitext(basename(chip_uri))[0]
+    reference_dir = join(check_dir, 'reference')
+    os.makedirs(join(reference_dir, chip_id))
+    shutil.copy(chip_uri, get_reference_uri(reference_dir, chip_uri))
+
+    with rasterio.open(chip_uri) as src:
+        profile = src.profile.copy()
+        labels = src.read(1)
+        coarse = src.read(1, out_shape=(src.height // 2, src.width // 2),
+                          resampling=Resampling.nearest)
+    coarse_profile = dict(profile, height=coarse.shape[0], width=coarse.shape[1],
+                          transform=profile['transform'] * Affine.scale(2))
+    coarse_uri = join(check_dir, 'coarse', basename(chip_uri))
+    os.makedirs(dirname(coarse_uri))
+    with rasterio.open(coarse_uri, 'w', **coarse_profile) as dst:
+        dst.write(coarse, 1)
+
+    lut = make_lut()
+    tmp_dir = join(check_dir, 'tmp')
+    os.makedirs(tmp_dir)
+    results = {}
+    for name, uri, arr, arr_profile, ref_dir in [
+            ('native', chip_uri, labels, profile, None),
+            ('reference', coarse_uri, coarse, coarse_profile, reference_dir)]:
+        _postprocess(uri, name, check_dir, lut, Profiler(), reference_dir=ref_dir)
+        fused_uri = join(check_dir, 'fused', name, basename(uri))
+        _write_prediction(arr, arr_profile, fused_uri, tmp_dir, lut,
+                          get_reference_uri(ref_dir, uri) if ref_dir else None)
+        with rasterio.open(join(check_dir, 'postprocess', name, basename(uri))) as a, \
+                rasterio.open(fused_uri) as b:
+            results[name] = bool(a.shape == b.shape and a.transform == b.transform and
+                                 np.array_equal(a.read(), b.read()))
+    return results
+
+
+def _run_child(conn, fn, args):
+    conn.send(fn(*args))
+    conn.close()
+
+
+def _in_fresh_process(fn, *args):
+    # Each benchmark runs in its own process so that peak RSS is not carried over from
+    # data generation or a previous benchmark. A plain Process rather than a Pool worker,
+    # since PREPROCESS starts its own pool and pool workers may not have children.
+    ctx = get_context('spawn')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_run_child, args=(child_conn, fn, args))
+    proc.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = None
+    proc.join()
+    if proc.exitcode != 0:
+        raise RuntimeError('{} exited with code {}'.format(fn.__name__, proc.exitcode))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure PREPROCESS and POSTPROCESS throughput on synthetic rasters')
+    parser.add_argument('--work_dir', default='/tmp/benchmark-throughput')
+    parser.add_argument('--scene_size', type=int, default=20000,
+                        help='width and height of the synthetic RGBA scene in pixels')
+    parser.add_argument('--nodata_fraction', type=float, default=0.5,
+                        help='width of the nodata band along the left edge as a fraction '
+                        'of the scene; whole split windows are empty once it is wider '
+                        'than a window')
+    parser.add_argument('--num_chips', type=int, default=500)
+    parser.add_argument('--preprocess_workers', type=int, default=1)
+    parser.add_argument('--postprocess_workers', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip_preprocess', action='store_true')
+    parser.add_argument('--skip_postprocess', action='store_true')
+    parser.add_argument('--skip_fused_check', action='store_true',
+                        help='skip comparing fused BATCH_PREDICT output with POSTPROCESS')
+    parser.add_argument('--output', help='write the results json here as well')
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    results = {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'rasterio': rasterio.__version__,
+        'cpu_count': os.cpu_count(),
+        'params': vars(args)
+    }
+
+    # Synthetic inputs are named by their parameters and reused across runs so that
+    # results from different commits are measured on identical data
+    if not args.skip_preprocess:
+        scene_id = 'synthetic-band-{}-{}-{}'.format(
+            args.scene_size, args.nodata_fraction, args.seed)
+        scene_uri = join(args.work_dir, 'area', scene_id, '{}.tif'.format(scene_id))
+        if not isfile(scene_uri):
+            os.makedirs(os.path.dirname(scene_uri), exist_ok=True)
+            print('Generating {0}x{0} scene'.format(args.scene_size))
+            make_scene(scene_uri, args.scene_size, args.nodata_fraction, args.seed)
+        print('Running PREPROCESS')
+        results['preprocess'] = _in_fresh_process(run_preprocess, scene_uri, args.work_dir,
+                                                  args.preprocess_workers)
+
+    if not args.skip_postprocess:
+        print('Generating {} prediction chips'.format(args.num_chips))
+        chip_uris = make_chips(join(args.work_dir, 'predict', 'seed-{}'.format(args.seed)),
+                               args.num_chips, args.seed)
+        print('Running POSTPROCESS')
+        results['postprocess'] = _in_fresh_process(run_postprocess, chip_uris,
+                                                   args.work_dir, args.postprocess_workers)
+        if not args.skip_fused_check:
+            print('Comparing fused BATCH_PREDICT output with POSTPROCESS')
+            results['fused_matches_postprocess'] = check_fused(chip_uris[0], args.work_dir)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
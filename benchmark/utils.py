@@ -1,3 +1,10 @@
+import hashlib
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
 def str_to_bool(x):
     if type(x) == str:
         if x.lower() == 'true':
@@ -7,3 +14,44 @@ def str_to_bool(x):
         else:
             raise ValueError('{} is expected to be true or false'.format(x))
     return x
+
+
+def bounded_map(fn, items, num_workers, max_pending=None):
+    # Like map, but fn runs on a pool of threads. Results are yielded in input order
+    # and at most max_pending items are in flight so long inputs are never fully
+    # buffered.
+    if num_workers <= 1:
+        yield from map(fn, items)
+        return
+
+    max_pending = max_pending or 2 * num_workers
+    with ThreadPoolExecutor(num_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def dataset_chip_key(chip_size, chip_opts, specs):
+    # Key for a whole set of chips: the chip settings and every spec (id, raster and
+    # label uris, split fingerprints) that goes into the train and validation scenes
+    key = json.dumps({
+        'chip_size': chip_size,
+        'chip_opts': chip_opts,
+        'specs': sorted(json.dumps(list(spec)) for spec in specs)
+    }, sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def retry(fn, attempts=3, delay=1.0):
+    # Call fn until it succeeds, backing off exponentially between attempts
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(delay * 2 ** attempt)